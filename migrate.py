@@ -36,7 +36,11 @@
 # for n users. As a rule of thumb the program will require one second per 60,000 user
 # accounts analyzed, plus one second per action taken (account migrating, deleting or
 # updating). Each action is performed with an individual ssh call to usermod, useradd or
-# deluser.
+# deluser unless the --batch option is used, in which case all actions are streamed as a
+# single shell script over one ssh session and cost only the time of the remote command.
+# Every ssh call of a run shares one master connection (OpenSSH ControlMaster) that is opened
+# by the connection test, so the handshake and key exchange are only paid once.
+# testing/benchmark.py measures these figures on synthetic accounts against a local fake destination.
 
 # PORTABILITY
 # To improve portability this program consists of only one file and uses only the common
@@ -49,21 +53,290 @@
 #   Account: A data structure representing a user's data with attributes like UID and password.
 #   Source: The machine that users are migrating from (currently the local machine).
 #   Destination: The machine that users are migrating to (always a remote host).
-#   Listed users: The users whose usernames are listed in the text file given to this program.
+#   Listed users: The users whose usernames are listed in the text file given to this program, or the users with
+#       PPP access in the VCN user database if --user-database is used.
 
+import anydbm
+import atexit
+import collections
 import commands
+import contextlib
+import ctypes
+import ctypes.util
 import fcntl
+import hashlib
+import heapq
+import json
+import multiprocessing
+import os
+import pipes
+import Queue
+import re
+import select
+import shutil
+import signal
+import struct
 import subprocess
 import sys
 import datetime
 import syslog
+import tempfile
+import threading
+import time
+import zlib
 
 # Constants
+DEFAULT_CACHE_DIR = '/var/cache/pymigrate'
 DEFAULT_REMOTE_BACKUP_DIR = '/mnt/pymigrate/backups'
+DEFAULT_BACKUPS_KEPT = 100  # Most backups kept at the destination, the least recently made or reused are pruned.
 DEFAULT_SSH_PORT = 22
+LOCAL_PASSWD_FILE, LOCAL_SHADOW_FILE = '/etc/passwd', '/etc/shadow'  # Source account files.
+LOCAL_GROUP_FILE = '/etc/group'  # Source of the groups that --create-groups copies.
 LOCK_FILE = "/var/run/vcn_user_data_migration.lck"
+SHARD_LOCK_FILE = "/var/run/vcn_user_data_migration_shards.lck"  # Byte N is locked while UID N is being synced.
+DATABASE_LOCK_FILE = "/usr/local/database/lock-file"  # Lock file of the VCN user database.
+DATABASE_USER_TYPE_FIELD = 13  # Tab separated field of a VCN user database record that holds the user's type.
+DATABASE_LISTED_TYPES = ('o', 'p', 'v')  # VCN user types with PPP access, which are the users to migrate.
+LISTED_USERS_FILE = 'listed_users'  # File in the cache directory holding the users listed on the last run.
+LOCAL_INDEX_FILE = 'local_index'  # File in the cache directory holding a digest of each local account.
+SSH_CONTROL_PERSIST = 300  # Seconds an idle master ssh connection outlives us if we die without closing it.
 LOWEST_USER_ID, HIGHEST_USER_ID = 1000, 60000  # Inclusive range of effected users.
 MOST_USERNAMES_TO_LIST = 5  # No message should dump more than this many usernames.
+STATUS_MARKER = '__PYMIGRATE_STATUS__'  # Prefixes the exit status lines that remote scripts report back.
+ACTION_VERBS = {'migrate': 'Migrating', 'delete': 'Deleting', 'update': 'Updating'}  # For progress messages.
+ACTION_PRIORITIES = {'delete': 0, 'update': 0, 'migrate': 1}  # Lower runs first. Only priority 0 beats --max-runtime.
+BACKUP_MARKER = '__PYMIGRATE_BACKUP__'  # Starts the line reporting the backup made during a snapshot fetch.
+GROUPS_MARKER = '__PYMIGRATE_GROUPS__'  # Starts the line listing the destination's GIDs during a snapshot fetch.
+SNAPSHOT_SEPARATOR = '__PYMIGRATE_SHADOW__'  # Separates passwd from shadow entries in a remote snapshot.
+SNAPSHOT_UNCHANGED = '__PYMIGRATE_UNCHANGED__'  # Sent instead of entries when the cached snapshot is current.
+FINGERPRINT_COMMAND = "stat -c '%i %s %y' /etc/passwd /etc/shadow | tr '\\n' ';'"  # Cheap change detector.
+DIGEST_LENGTH = 16  # Hex digits kept of each account's digest in --remote-diff mode.
+PERL_MISSING_STATUS = 127  # Exit status of the remote perl helpers' commands when perl isn't installed there.
+
+# Perl helper that --remote-diff runs at the destination. In "digests" mode it prints username:uid:gid:digest for
+# each in-range account, where the digest covers the fields that categorization compares (see accountDigest()).
+# In "rows" mode it reads usernames from stdin and prints just their passwd entries, a separator and their shadow
+# entries, the same as a full snapshot fetch.
+REMOTE_DIGEST_HELPER = '''use strict;
+use Digest::MD5 qw(md5_hex);
+my ($mode, $low, $high, $separator, $length) = @ARGV;
+my (%wanted, @passwd, %kept, @shadow, %password);
+if ($mode eq "rows") {
+    while (my $name = <STDIN>) { chomp($name); $wanted{$name} = 1; }
+}
+open(my $passwdFile, "<", "/etc/passwd") or exit 1;
+while (my $line = <$passwdFile>) {
+    chomp($line);
+    my @fields = split(/:/, $line, -1);
+    next unless @fields >= 5 && $fields[2] =~ /^[0-9]+$/ && $fields[2] >= $low && $fields[2] <= $high;
+    next if $mode eq "rows" && !$wanted{$fields[0]};
+    push(@passwd, [$line, @fields]);
+    $kept{$fields[0]} = 1;
+    $password{$fields[0]} = $fields[1];
+}
+close($passwdFile);
+open(my $shadowFile, "<", "/etc/shadow") or exit 1;
+while (my $line = <$shadowFile>) {
+    chomp($line);
+    my @fields = split(/:/, $line, 3);
+    next unless @fields > 1 && $kept{$fields[0]};
+    push(@shadow, $line);
+    $password{$fields[0]} = $fields[1];
+}
+close($shadowFile);
+if ($mode eq "rows") {
+    print "$_->[0]\\n" foreach @passwd;
+    print "$separator\\n";
+    print "$_\\n" foreach @shadow;
+} else {
+    foreach my $entry (@passwd) {
+        my (undef, $name, undef, $uid, $gid, $gecos) = @$entry;
+        my $digest = substr(md5_hex(join(":", $password{$name}, $uid, $gecos)), 0, $length);
+        print join(":", $name, $uid, $gid, $digest), "\\n";
+    }
+}
+'''
+# Perl helper that --bulk runs at the destination to apply a whole list of changes by rewriting passwd, shadow
+# and (for deletions) group and gshadow once. It takes the same locks as the standard tools (lckpwdf()'s fcntl
+# lock on .pwd.lock and the shadow-utils .lock files), makes each change the way useradd, deluser or usermod would
+# (home /home, shell /usr/sbin/nologin), refuses to touch UIDs outside the managed range, checks the result and
+# installs every file with an atomic rename. Changes arrive on stdin as index:kind:username:password:uid:gid:gecos
+# and a "MARKER index status" line is printed for each one after the files are installed, so nothing is reported
+# as done if the files weren't replaced. Its arguments are the etc directory (with a trailing slash), the managed
+# UID range and the marker.
+REMOTE_BULK_HELPER = '''use strict;
+use Fcntl qw(O_WRONLY O_CREAT O_EXCL F_SETLKW F_WRLCK SEEK_SET);
+use IO::Handle;
+my ($etc, $low, $high, $marker) = @ARGV;
+my (@lockFiles, @results, %deleted, %touched);
+
+sub fail { print "$_[0]\\n"; exit 1; }
+sub inRange { return $_[0] =~ /^[0-9]+$/ && $_[0] >= $low && $_[0] <= $high; }
+sub readRows {
+    my ($path, $optional) = @_;
+    open(my $in, "<", $path) or ($optional ? return () : fail("Unable to read $path: $!"));
+    my @rows = map { chomp; [split(/:/, $_, -1)] } <$in>;
+    close($in);
+    return @rows;
+}
+sub withoutDeleted {
+    return defined($_[0]) ? join(",", grep { !$deleted{$_} } split(/,/, $_[0])) : undef;
+}
+sub lockFile {
+    my ($path) = @_;
+    open(my $out, ">", "$path.$$") or fail("Unable to create $path.$$: $!");
+    print $out $$;
+    close($out);
+    foreach my $attempt (1, 2) {
+        if (link("$path.$$", "$path.lock")) {
+            push(@lockFiles, "$path.lock");
+            unlink("$path.$$");
+            return;
+        }
+        open(my $in, "<", "$path.lock") or next;
+        my $pid = <$in>;
+        close($in);
+        last if $pid =~ /^[0-9]+$/ && kill(0, $pid);
+        unlink("$path.lock");
+    }
+    unlink("$path.$$");
+    fail("$path is locked by another program");
+}
+sub writeRows {
+    my ($path, $rows) = @_;
+    my @stat = stat($path) or fail("Unable to stat $path: $!");
+    unlink("$path+");
+    sysopen(my $out, "$path+", O_WRONLY | O_CREAT | O_EXCL, 0600) or fail("Unable to create $path+: $!");
+    chown($stat[4], $stat[5], "$path+");
+    chmod($stat[2] & 07777, "$path+");
+    print $out map { join(":", @$_) . "\\n" } @$rows;
+    $out->flush() && $out->sync() && close($out) or fail("Unable to write $path+: $!");
+}
+END { unlink(@lockFiles); }
+
+# Read the changes, then take the same locks as the standard tools: lckpwdf() and the shadow-utils lock files.
+my @changes = map { chomp; [split(/:/, $_, 7)] } <STDIN>;
+sysopen(my $lock, "${etc}.pwd.lock", O_WRONLY | O_CREAT, 0600) or fail("Unable to open ${etc}.pwd.lock: $!");
+my $lockRequest = pack("ss", F_WRLCK, SEEK_SET) . ("\\0" x 28);  # A struct flock covering the whole file.
+local $SIG{ALRM} = sub { fail("Timed out waiting for ${etc}.pwd.lock"); };
+alarm(15);
+fcntl($lock, F_SETLKW, $lockRequest) or fail("Unable to lock ${etc}.pwd.lock: $!");
+alarm(0);
+lockFile("$etc$_") foreach ("passwd", "shadow", "group", (-e "${etc}gshadow" ? "gshadow" : ()));
+
+my %defaults = (PASS_MIN_DAYS => 0, PASS_MAX_DAYS => 99999, PASS_WARN_AGE => 7);
+foreach (readRows("${etc}login.defs", 1)) {
+    $defaults{$1} = $2 if join(":", @$_) =~ /^\\s*(PASS_MIN_DAYS|PASS_MAX_DAYS|PASS_WARN_AGE)\\s+([0-9]+)/;
+}
+
+my @passwd = readRows("${etc}passwd");
+my @shadow = readRows("${etc}shadow");
+my @group = readRows("${etc}group");
+my @gshadow = readRows("${etc}gshadow", 1);
+my (%userRow, %uidUser, %shadowRow, %groups);
+foreach (@passwd) { $userRow{$_->[0]} ||= $_; $uidUser{$_->[2]} = $_->[0]; }
+foreach (@shadow) { $shadowRow{$_->[0]} ||= $_; }
+foreach (@group) { $groups{$_->[0]} = $groups{$_->[2]} = 1; }
+my $protected = join("\\n", map { join(":", @$_) } grep { !inRange($_->[2]) } @passwd);
+my $today = int(time() / 86400);
+
+# Make each change to the in-memory copy of the files, the same way useradd, deluser and usermod would.
+foreach my $change (@changes) {
+    my ($index, $kind, $name, $password, $uid, $gid, $gecos) = @$change;
+    my $row = $userRow{$name};
+    if (grep { defined($_) && /[:\\n]/ } ($password, $uid, $gid, $gecos)) {
+        push(@results, [$index, 2, "invalid account fields"]);
+    } elsif ($kind eq "migrate") {
+        if ($row) { push(@results, [$index, 9, "user '$name' already exists"]); next; }
+        if (!inRange($uid)) { push(@results, [$index, 2, "UID $uid is outside the managed range"]); next; }
+        if (defined($uidUser{$uid})) { push(@results, [$index, 4, "UID $uid is not unique"]); next; }
+        if (!$groups{$gid}) { push(@results, [$index, 6, "group '$gid' does not exist"]); next; }
+        $row = [$name, "x", $uid, $gid, $gecos, "/home", "/usr/sbin/nologin"];
+        push(@passwd, $row);
+        $userRow{$name} = $row;
+        $uidUser{$uid} = $name;
+        $shadowRow{$name} = [$name, $password, $today, $defaults{PASS_MIN_DAYS}, $defaults{PASS_MAX_DAYS},
+                             $defaults{PASS_WARN_AGE}, "", "", ""];
+        push(@shadow, $shadowRow{$name});
+        $touched{$name} = 1;
+        push(@results, [$index, 0, ""]);
+    } elsif ($kind eq "delete") {
+        if (!$row) { push(@results, [$index, 2, "The user `$name' does not exist."]); next; }
+        if (!inRange($row->[2])) { push(@results, [$index, 2, "UID $row->[2] is outside the managed range"]); next; }
+        delete($userRow{$name});
+        delete($uidUser{$row->[2]});
+        delete($shadowRow{$name});
+        $deleted{$name} = $touched{$name} = 1;
+        push(@results, [$index, 0, ""]);
+    } elsif ($kind eq "update") {
+        if (!$row) { push(@results, [$index, 6, "user '$name' does not exist"]); next; }
+        if (!inRange($row->[2]) || !inRange($uid)) {
+            push(@results, [$index, 2, "UID is outside the managed range"]);
+            next;
+        }
+        if (defined($uidUser{$uid}) && $uidUser{$uid} ne $name) {
+            push(@results, [$index, 4, "UID '$uid' already exists"]);
+            next;
+        }
+        delete($uidUser{$row->[2]});
+        ($row->[2], $row->[4]) = ($uid, $gecos);
+        $uidUser{$uid} = $name;
+        if (!$shadowRow{$name}) {
+            $shadowRow{$name} = [$name, "", "", "", "", "", "", "", ""];
+            push(@shadow, $shadowRow{$name});
+        }
+        ($shadowRow{$name}[1], $shadowRow{$name}[2]) = ($password, $today);
+        $touched{$name} = 1;
+        push(@results, [$index, 0, ""]);
+    } else {
+        push(@results, [$index, 2, "unknown change '$kind'"]);
+    }
+}
+
+# Drop the replaced and deleted rows of changed users, and take deleted users out of group member lists.
+@passwd = grep { !$touched{$_->[0]} || ($userRow{$_->[0]} || 0) == $_ } @passwd;
+@shadow = grep { !$touched{$_->[0]} || ($shadowRow{$_->[0]} || 0) == $_ } @shadow;
+my $groupsBefore = join("\\n", map { join(":", @$_) } @group, @gshadow);
+$_->[3] = withoutDeleted($_->[3]) foreach (@group);
+$_->[2] = withoutDeleted($_->[2]), $_->[3] = withoutDeleted($_->[3]) foreach (@gshadow);
+my $groupsChanged = $groupsBefore ne join("\\n", map { join(":", @$_) } @group, @gshadow);
+
+# Check the result before installing anything: every row is complete, no username appears twice and the
+# accounts outside the managed UID range are exactly as they were.
+my (%passwdNames, %shadowNames);
+foreach (@passwd) { fail("Invalid passwd entry for $_->[0]") if @$_ != 7 || $passwdNames{$_->[0]}++; }
+foreach (@shadow) { fail("Invalid shadow entry for $_->[0]") if @$_ != 9 || $shadowNames{$_->[0]}++; }
+foreach (keys %touched) { fail("Missing shadow entry for $_") if $passwdNames{$_} && !$shadowNames{$_}; }
+fail("Accounts outside the managed UID range would change")
+    if $protected ne join("\\n", map { join(":", @$_) } grep { !inRange($_->[2]) } @passwd);
+
+# Write every new file in full before replacing any, keeping the old ones as file- like the standard tools do.
+my @files = (["shadow", \\@shadow], ["passwd", \\@passwd]);
+unshift(@files, ["group", \\@group], (@gshadow ? (["gshadow", \\@gshadow]) : ())) if $groupsChanged;
+writeRows("$etc$_->[0]", $_->[1]) foreach (@files);
+foreach (@files) {
+    my $path = "$etc$_->[0]";
+    unlink("$path-");
+    link($path, "$path-");
+    rename("$path+", $path) or fail("Unable to replace $path: $!");
+}
+system("nscd -i passwd -i group >/dev/null 2>&1") if -x "/usr/sbin/nscd";
+
+foreach (@results) {
+    my ($index, $status, $message) = @$_;
+    print "$message\\n" if $status != 0;
+    print "$marker $index $status\\n";
+}
+'''
+ACTION_NO_STATUS = 255  # Status assumed for actions whose exit status never came back.
+ACTION_DEFERRED = 254  # Status of actions left for the next run because the --max-runtime budget ran out.
+ACTION_UNCONVERGED = 253  # Status of actions that reported success but whose change --verify didn't find.
+BATCH_WINDOW = 32  # Most batched actions sent ahead of the one running, with --max-runtime, so deadlines stay close.
+WATCH_DEBOUNCE = 2  # Seconds of quiet that end a burst of file changes in --watch mode.
+WATCH_DEBOUNCE_LIMIT = 30  # Most seconds a continuous burst of file changes can hold back a sync.
+WATCH_POLL_INTERVAL = 1  # Seconds between file checks in --watch mode when inotify isn't available.
+WATCH_RESYNC_INTERVAL = 3600  # Seconds between checks for destination-side changes in --watch mode.
+INOTIFY_EVENTS = 0x8 | 0x80 | 0x100 | 0x200  # IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
 
 # Console return values
 EXIT_CODE_SUCCESS = 0  # Program ran without problems.
@@ -76,33 +349,425 @@ EXIT_CODE_INSTANCE_ALREADY_RUNNING = 6  # Program quit because multiple instance
 EXIT_CODE_NOT_ROOT = 7  # Program wasn't run with root authority.
 EXIT_CODE_SUB_UID_MAXED_OUT = 8  # Destination may have reached the limit of subordinate UIDs.
 EXIT_CODE_UNABLE_TO_CONNECT = 9  # Destination was unreachable.
+EXIT_CODE_UNABLE_TO_READ_REMOTE = 10  # Destination's /etc/passwd or /etc/shadow couldn't be read.
+EXIT_CODE_DESTINATION_FAILED = 11  # Some of several destinations couldn't be synchronized.
+EXIT_CODE_PLAN_OUTDATED = 12  # A saved plan no longer matches the local accounts it was made from.
+EXIT_CODE_DATABASE_LOCKED = 13  # The VCN user database was locked by another program.
+EXIT_CODE_BAD_OPTIONS = 14  # Program was given options that are invalid or can't be used together.
+EXIT_CODE_UNCONVERGED = 15  # Changes made at the destination didn't all show up when checked with --verify.
 
 # Global variables
 lockFile = None  # File handle for locking out multiple running instances (fcntl requires this to be global).
 options = None  # A dictionary of command-line option values.
+sshControlDir = None  # Private directory holding the control sockets of master ssh connections.
+sshControlPaths = {}  # Control socket paths of the open master ssh connections, keyed by destination.
+sshControlLock = threading.Lock()  # Guards sshControlDir and sshControlPaths while destinations connect.
+outputLock = threading.Lock()  # Keeps lines printed by different destinations' threads from interleaving.
+threadState = threading.local()  # Per-thread state, such as the destination prefix for printed messages.
+destinationSnapshots = {}  # In-memory (fingerprint, Account dictionary) snapshots, keyed by destination.
+runStats = None  # The RunStats of the current run.
+runStartTime = None  # When the current run started, which the --max-runtime budget is measured from.
+planFile = None  # File handle that --plan writes the plan to.
+remoteBackups = {}  # (exit status, archive name) of the backup made while reading each destination's groups.
+destinationGroups = {}  # Set of the GIDs in each destination's /etc/group when its accounts were last read.
+remoteFingerprints = {}  # Fingerprint of each destination's passwd and shadow when its accounts were last read.
+actionFingerprints = {}  # Fingerprint of each destination's passwd and shadow reported after the last action applied.
+actionJournals = {}  # Open journal files of the destinations whose actions are being applied, keyed by destination.
+journalLock = threading.Lock()  # Keeps journal records written by different lanes from interleaving.
+destinationOutcomes = {}  # (succeeded, failed, deferred) usernames by action kind of the last actions applied to each destination.
+sourceState = None  # Labels of the local accounts and user list this run syncs from (see scanLocalChanges()).
+localAccounts = None  # Local accounts parsed on demand, for runs that started without them (see loadLocalUsers()).
+localAccountsLock = threading.Lock()  # Keeps destinations' threads from parsing the local accounts more than once.
+shard = None  # (lowest UID, highest UID) of the shard this worker process synchronizes, or None for the whole range.
+shardLockFile = None  # File handle holding the lock on this worker's shard (fcntl requires this to be global).
+shardLockEvents = []  # (shard, event) pairs of this run's workers; the event is set once the shard's lock was tried.
 
 
 # An object to represent the attributes of a Linux user account.
-class Account:
-    # Construct an Account object from an /etc/passwd entry.
-    def __init__(self, passwdEntry):
-        # Pull the needed fields from the entries. The field ordering in passwd and shadow are:
-        #    username:password:userID:groupID:gecos:homeDir:shell
-        #    username:password:lastchanged:minimum:maximum:warn:inactive:expire
-        [self.username, self.password, self.uid, self.gid, self.gecos,
-            self.homeDir, self.shell] = passwdEntry.split(':')
+# Only the fields that are compared or copied are kept, and __slots__ drops the per-instance dictionary, so
+# that a million accounts fit comfortably in memory.
+class Account(object):
+    __slots__ = ('username', 'password', 'uid', 'gid', 'gecos')
+
+    # Construct an Account object from the fields of an /etc/passwd entry.
+    def __init__(self, username, password, uid, gid, gecos):
+        self.username, self.password, self.uid, self.gid, self.gecos = username, password, uid, gid, gecos
+
+
+# A single change to be made at the destination. The kind is one of 'migrate', 'delete' or 'update' and
+# the command is the shell command line that performs it at the destination. Claims and releases are
+# the UIDs the action takes up and frees at the destination (or None) and are used to order actions. The account
+# is the local Account being migrated or copied (None for deletions).
+Action = collections.namedtuple('Action', 'kind username command claims releases account')
+
+
+# The outcome of synchronizing a destination, as returned by Synchronizer.sync(): the exit code the command line
+# would report for it with its message, and the users whose changes succeeded, failed or were deferred there.
+SyncResult = collections.namedtuple('SyncResult',
+                                    'destination exitCode message migrated deleted updated failed deferred')
+
+
+# An error that stops the synchronization of a destination. It carries the exit code to report for it.
+class MigrationError(Exception):
+    def __init__(self, msg, exitCode):
+        Exception.__init__(self, msg)
+        self.exitCode = exitCode
+
+
+# Wall time per phase, operation counters and action latencies of a run, for the --stats option. Phases timed
+# while synchronizing a destination are kept separately for each destination. Safe to use from several threads.
+class RunStats(object):
+    def __init__(self):
+        self.startTime = time.time()
+        self.lock = threading.Lock()
+        self.phases, self.destinationPhases = {}, collections.defaultdict(dict)
+        self.counters, self.latencies = collections.defaultdict(int), []
+
+    # Add to one of the counters.
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    # Record how long one action took to apply.
+    def latency(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    # Time the enclosed block as a phase: "with runStats.phase('fetch'):".
+    @contextlib.contextmanager
+    def phase(self, name):
+        startTime = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - startTime
+            destination = getattr(threadState, 'destination', None)
+            with self.lock:
+                phases = self.phases if destination is None else self.destinationPhases[destination]
+                phases[name] = phases.get(name, 0) + elapsed
+
+    # Get the nearest-rank percentiles of the action latencies.
+    def percentiles(self):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {}
+        result = {'max': latencies[-1]}
+        for percent in (50, 90, 99):
+            result['p' + str(percent)] = latencies[max(0, (len(latencies) * percent + 99) // 100 - 1)]
+        return result
+
+    # Get everything that was recorded as a dictionary ready to be turned into JSON.
+    def report(self):
+        with self.lock:
+            return {'time': datetime.datetime.now().isoformat(), 'total': time.time() - self.startTime,
+                    'phases': dict(self.phases), 'destinations': dict(self.destinationPhases),
+                    'counters': dict(self.counters), 'actions': len(self.latencies),
+                    'actionLatency': self.percentiles()}
+
+    # Condense the report into one line. Destination phases are summed over all destinations.
+    def summary(self):
+        report = self.report()
+        phases = dict(report['phases'])
+        for destinationPhases in report['destinations'].itervalues():
+            for name, seconds in destinationPhases.iteritems():
+                phases[name] = phases.get(name, 0) + seconds
+        line = "Stats: total %.2fs" % report['total']
+        for name in ('readList', 'parseSource', 'connect', 'fetch', 'categorize', 'backup', 'apply', 'verify',
+                     'cacheUpdate'):
+            if name in phases:
+                line += ", %s %.2fs" % (name, phases[name])
+        line += "; %d ssh processes, %d bytes read from destinations; %d actions" % \
+            (report['counters'].get('sshProcesses', 0), report['counters'].get('remoteBytes', 0), report['actions'])
+        if report['actionLatency']:
+            line += ", latency p50 %(p50).3fs p90 %(p90).3fs p99 %(p99).3fs max %(max).3fs" % report['actionLatency']
+        return line
+
+
+# Get the digest of the fields of an account that categorization compares, as REMOTE_DIGEST_HELPER computes it.
+def accountDigest(account):
+    return hashlib.md5(account.password + ':' + account.uid + ':' + account.gecos).hexdigest()[:DIGEST_LENGTH]
+
+
+# Construct the destination shell command that creates a new user account.
+# NOTE: home directory will be forced to /home and shell to /usr/sbin/nologin
+def addUserCommand(account):
+    return "/usr/sbin/useradd -p " + pipes.quote(account.password) + " -u " + account.uid + \
+           " -g " + account.gid + " -c " + pipes.quote(account.gecos) + \
+           " -d /home -M -s /usr/sbin/nologin -K MAIL_DIR=/dev/null " + account.username
+
+
+# Turn plan records (see writePlan()) into a list of Actions. Stand-in destination accounts carry the destination
+# UIDs recorded in the plan, which is all that buildActions() needs from them.
+def actionsFromRecords(records, srcAccountDict):
+    destAccountDict = {}
+    for record in records:
+        destAccountDict[record['user']] = Account(record['user'], None, record['destinationUid'], None, None)
+    return buildActions([record['user'] for record in records if record['action'] == 'migrate'],
+                        [record['user'] for record in records if record['action'] == 'delete'],
+                        [record['user'] for record in records if record['action'] == 'update'],
+                        srcAccountDict, destAccountDict)
+
+
+# Perform a list of Actions at a remote machine and return a list of their exit statuses in the same order.
+# The actions are scheduled into options['jobs'] sequences (see scheduleActions) that are worked through at the
+# same time, deletions and updates first. Migrations still waiting when the --max-runtime budget runs out are
+# deferred (see deferAction).
+def applyActions(target, actions):
+    if options['bulk']:
+        return applyActionsInBulk(target, actions)
+
+    statuses = [ACTION_NO_STATUS] * len(actions)
+    sequences = scheduleActions(actions, options['jobs'])
+
+    if options['batch']:
+        # Stream each sequence over its own batched ssh session.
+        def applySession(session):
+            for index, status in zip(session, executeBatch(target, [actions[i] for i in session], session)):
+                statuses[index] = status
+        runInParallel(applySession, sequences, len(sequences))
+
+    else:
+        def applySequence(sequence):
+            for index in sequence:
+                if deferAction(actions[index]):
+                    statuses[index] = ACTION_DEFERRED
+                    continue
+                printVerbose("    " + ACTION_VERBS[actions[index].kind] + " user: " + actions[index].username)
+                startTime = time.time()
+                statuses[index], fingerprint = executeAction(target, actions[index])
+                runStats.latency(time.time() - startTime)
+                if fingerprint is not None:
+                    journalAction(target, index, statuses[index], fingerprint)
+        runInParallel(applySequence, sequences, len(sequences))
+
+    return statuses
+
+
+# Apply a list of Actions to a remote machine in one go with REMOTE_BULK_HELPER, which rewrites the account files
+# once instead of running a tool per action, and return their exit statuses. Scheduling the actions as a single
+# sequence keeps UIDs released before they are claimed. Migrations are deferred if the --max-runtime budget is
+# already spent when they would be sent. If the files couldn't be replaced then every other action keeps
+# ACTION_NO_STATUS. The account files are the ones in etcDir, which needs a trailing slash.
+def applyActionsInBulk(target, actions, etcDir='/etc/'):
+    statuses = [ACTION_NO_STATUS] * len(actions)
+    outputs = [[] for action in actions]
+    if not actions:
+        return statuses
+
+    command = remotePerlCommand(REMOTE_BULK_HELPER, pipes.quote(etcDir) + " " + str(LOWEST_USER_ID) + " " +
+                                str(HIGHEST_USER_ID) + " " + STATUS_MARKER) + "; status=$?; " + \
+              "echo \"" + STATUS_MARKER + " - 0 $(" + FINGERPRINT_COMMAND + ")\"; exit $status"
+    runStats.count('sshProcesses')
+    process = subprocess.Popen(sshArguments(target) + [command],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    # Send the changes from a separate thread so that neither side's pipe can fill up and stall the other.
+    def writeChanges():
+        try:
+            for index in scheduleActions(actions, 1)[0]:
+                if deferAction(actions[index]):
+                    statuses[index] = ACTION_DEFERRED
+                    continue
+                account = actions[index].account or Account(actions[index].username, '', '', '', '')
+                process.stdin.write(':'.join([str(index), actions[index].kind, account.username, account.password,
+                                              account.uid, account.gid, account.gecos]) + '\n')
+            process.stdin.close()
+        except IOError:  # The helper ended early. Its output says why.
+            pass
+    writer = threading.Thread(target=writeChanges)
+    writer.start()
+
+    # Collect output until each status line arrives, then file it under the action it belongs to. The last status
+    # line carries the fingerprint of the files that were installed.
+    startTime, pending, fingerprint = time.time(), [], None
+    for line in iter(process.stdout.readline, ''):
+        runStats.count('remoteBytes', len(line))
+        if not line.startswith(STATUS_MARKER + ' '):
+            pending.append(line.rstrip('\n'))
+            continue
+        fields = line.rstrip('\n').split(None, 3)
+        if fields[1] == '-':
+            fingerprint = fields[3] if len(fields) > 3 else None
+            continue
+        index, status = int(fields[1]), int(fields[2])
+        statuses[index], outputs[index], pending = status, pending, []
+        runStats.latency((time.time() - startTime) / len(actions))
+        printVerbose("    " + ACTION_VERBS[actions[index].kind] + " user: " + actions[index].username)
+    writer.join()
+    process.wait()
+    if fingerprint is not None:
+        for index, status in enumerate(statuses):
+            if status not in (ACTION_NO_STATUS, ACTION_DEFERRED):
+                journalAction(target, index, status, fingerprint)
+
+    if process.returncode == PERL_MISSING_STATUS:
+        printLoud("WARNING: Unable to apply changes in bulk. " + str(perlMissingError(target)))
+    elif process.returncode != 0:
+        printLoud("WARNING: Unable to apply changes in bulk (exit code " + str(process.returncode) + "):\n  " +
+                  "\n  ".join(pending))
+    for index, action in enumerate(actions):
+        if statuses[index] not in (0, ACTION_DEFERRED) and process.returncode == 0:
+            printLoud("WARNING: Non-zero exit code on bulk change: " + ACTION_VERBS[action.kind] + " user " +
+                      action.username + "\n  " + "\n  ".join(outputs[index]))
+    return statuses
+
+
+# Apply a plan saved by --plan to the destinations it names and return a list of (destination, exit code,
+# message) results like syncDestinations(). Every change in the plan is first checked against the local accounts
+# it was planned from, and nothing is applied if any of them have changed since. In --simulate mode the changes
+# are only shown.
+def applyPlan(planFilename):
+    printVerbose("Loading local users...")
+    with runStats.phase('parseSource'):
+        srcAccountDict = getLocalUsers()
+
+    # Group the changes by destination and check each against the local account it was planned from.
+    recordsByDestination, outdatedUsers = collections.OrderedDict(), []
+    for record in readPlan(planFilename):
+        if record['action'] not in ACTION_VERBS:
+            continue
+        srcAccount = srcAccountDict.get(record['user'])
+        if (srcAccount and accountDigest(srcAccount)) != record['sourceDigest']:
+            outdatedUsers.append(record['user'])
+        recordsByDestination.setdefault(record['destination'], []).append(record)
+    if outdatedUsers:
+        raise MigrationError("The plan no longer matches the local accounts of " +
+                             usernameListToLimitedString(outdatedUsers) + ". Make a new plan.", EXIT_CODE_PLAN_OUTDATED)
+
+    def applyRecords(destAddress):
+        if options['simulate']:
+            categories = {'migrate': [], 'delete': [], 'update': []}
+            for record in recordsByDestination[destAddress]:
+                categories[record['action']].append(record['user'])
+            printMessage("Simulated Plan\n" +
+                         "--------------\n" +
+                         "  Migrate:   " + usernameListToLimitedString(categories['migrate']) + "\n" +
+                         "  Delete:    " + usernameListToLimitedString(categories['delete']) + "\n" +
+                         "  Update:    " + usernameListToLimitedString(categories['update']))
+            return
+
+        status, output = openSshMaster(destAddress)
+        if status != 0:
+            raise MigrationError(output, EXIT_CODE_UNABLE_TO_CONNECT)
+        if options['resume'] and resumeDestination(destAddress, srcAccountDict):
+            return
+
+        performPlannedActions(destAddress, actionsFromRecords(recordsByDestination[destAddress], srcAccountDict),
+                              srcAccountDict)
+
+    return runForDestinations(recordsByDestination.keys(), applyRecords)
+
+
+# Construct the destination shell command that backs up /etc/passwd and /etc/shadow. Backups are gzipped tar
+# archives named after a hash of both files, so an unchanged pair is never copied twice: its archive is only
+# touched, which also keeps it from being pruned. Only the --keep-backups most recently made or reused archives
+# are kept. Archives hold password hashes, so they are only readable by root. Each archive is written under a
+# temporary name of the remote shell's own, since shard workers may back up the same files at once, and an archive
+# that another one finished first counts as made. The command leaves the archive's name in $backup.
+def backupCommand():
+    backupDir = pipes.quote(options['backupDir'])
+    command = "umask 077 && mkdir -p " + backupDir + " && " + \
+              "backup=$(cat /etc/passwd /etc/shadow | sha256sum | cut -c1-64).tar.gz && " + \
+              "if [ -e " + backupDir + "/$backup ]; then touch " + backupDir + "/$backup; else " + \
+              "{ tar -czf " + backupDir + "/$backup.$$.new -C /etc passwd shadow && " + \
+              "mv " + backupDir + "/$backup.$$.new " + backupDir + "/$backup; } || " + \
+              "{ rm -f " + backupDir + "/$backup.$$.new; [ -e " + backupDir + "/$backup ]; }; fi"
+    if options['backupsKept'] > 0:
+        command += " && { ls -t " + backupDir + "/*.tar.gz | tail -n +" + str(options['backupsKept'] + 1) + \
+                   " | xargs -r rm -f; }"
+    return command
+
+
+# Back up a destination and read the GIDs of its /etc/group in one ssh call, for runs that don't fetch its accounts
+# (such as when applying a saved plan). The outcomes are recorded (see recordBackup() and recordGroups()), so
+# performActions() doesn't make another backup and checkDestinationGroups() can check migrations.
+def backupRemoteAndReadGroups(target):
+    runStats.count('sshProcesses')
+    status, output = commands.getstatusoutput(sshCommand(target, remoteReportScript(True, True)))
+    runStats.count('remoteBytes', len(output))
+    lines = output.split('\n')
+    recordBackup(target, next((line for line in lines if line.startswith(BACKUP_MARKER + ' ')), ''))
+    recordGroups(target, next((line for line in lines if line.startswith(GROUPS_MARKER + ' ')), ''))
+
+
+# Turn categorized users into a list of Actions. The UIDs each action claims and releases let applyActions() keep
+# dependent actions in order.
+def buildActions(migratingUsers, doomedUsers, updatingUsers, srcAccountDict, destAccountDict):
+    actions = []
+    for username in migratingUsers:
+        actions.append(Action('migrate', username, addUserCommand(srcAccountDict[username]),
+                              srcAccountDict[username].uid, None, srcAccountDict[username]))
+    for username in doomedUsers:
+        actions.append(Action('delete', username, deleteUserCommand(username),
+                              None, destAccountDict[username].uid, None))
+    for username in updatingUsers:
+        oldUid, newUid = destAccountDict[username].uid, srcAccountDict[username].uid
+        if oldUid == newUid:
+            oldUid, newUid = None, None
+        actions.append(Action('update', username, updateUserCommand(srcAccountDict[username]),
+                              newUid, oldUid, srcAccountDict[username]))
+    return actions
+
+
+# Sort users into those to migrate, delete and update at a destination. Each rule walks only the collection it is
+# about, so no combined list of every username is ever built. If candidateUsers is given then only those users
+# are considered, which is enough when every other user is known to be in sync already.
+def categorizeUsers(listedUsers, srcAccountDict, destAccountDict, candidateUsers=None):
+    printVerbose("Categorizing users.")
+    migratingUsers, doomedUsers, updatingUsers = [], [], []
 
+    listedCandidates, destCandidates = listedUsers, destAccountDict
+    if candidateUsers is not None:
+        listedCandidates = [userName for userName in candidateUsers if userName in listedUsers]
+        destCandidates = dict([(userName, destAccountDict[userName]) for userName in candidateUsers
+                               if userName in destAccountDict])
 
-# Create a new user account at a remote machine.
-# NOTE: home directory will be forced to /home and shell to /usr/sbin/nologin
-def addRemoteUser(target, account):
-    # Construct and execute command to remotely add user.
-    cmd = "ssh -p" + str(options['port']) + " -n " + target + " /usr/sbin/useradd -p \\''" + account.password + \
-          "'\\' -u " + account.uid + " -g " + account.gid + \
-          " -c \\''" + account.gecos + "'\\'" + \
-          " -d /home -M -s /usr/sbin/nologin -K MAIL_DIR=/dev/null " + account.username
-    status = executeCommand(cmd)
-    return status
+    # Listed users found at source but not at destination get migrated.
+    for userName in listedCandidates:
+        if userName in srcAccountDict and userName not in destAccountDict:
+            migratingUsers.append(userName)
+
+    for userName, destAccount in destCandidates.iteritems():
+        # Any users at destination and not at source should be marked for deletion.
+        if userName not in srcAccountDict:
+            doomedUsers.append(userName)
+            continue
+
+        # Optionally mark for deletion users that exist at both ends but are no longer listed.
+        if options['unlistedGetDeleted'] and userName not in listedUsers:
+            doomedUsers.append(userName)
+
+        # Update users that have changed their password, UID or full name (gecos).
+        srcAccount = srcAccountDict[userName]
+        if srcAccount.password != destAccount.password or srcAccount.uid != destAccount.uid or \
+           srcAccount.gecos != destAccount.gecos:
+            updatingUsers.append(userName)
+
+    return migratingUsers, doomedUsers, updatingUsers
+
+
+# Check the groups of users about to be migrated against the GIDs read with the destination's snapshot, and return
+# the users whose groups exist along with those whose groups don't. With --create-groups the missing groups are
+# first copied from the local /etc/group in one ssh call, or if create is unset (when only planning or simulating)
+# the ones that could be copied count as existing. Nothing is checked if the destination's GIDs weren't read.
+def checkDestinationGroups(destAddress, migratingUsers, srcAccountDict, create=True):
+    groups = destinationGroups.get(destAddress)
+    if groups is None:
+        return migratingUsers, []
+
+    missingGids = set([srcAccountDict[userName].gid for userName in migratingUsers]) - groups
+    if missingGids and options['createGroups'] and create:
+        groups |= createRemoteGroups(destAddress, missingGids)
+    elif missingGids and options['createGroups']:
+        groups = groups | (missingGids & set(getLocalGroups()))
+
+    groupedUsers, skippedUsers = [], []
+    for userName in migratingUsers:
+        if srcAccountDict[userName].gid in groups:
+            groupedUsers.append(userName)
+        else:
+            skippedUsers.append(userName)
+    return groupedUsers, skippedUsers
 
 
 # Open and close the lock file to test for root privilege.
@@ -114,108 +779,770 @@ def checkForRootPrivilege():
         testFile.close()
     except IOError as e:
         if e[0] == 13:
-            logExit(syslog.LOG_ERR, "Program must be run with root authority.",
-                    EXIT_CODE_NOT_ROOT)
+            raise MigrationError("Program must be run with root authority.", EXIT_CODE_NOT_ROOT)
         else:
-            logExit(syslog.LOG_ERR, "Creating " + LOCK_FILE + " triggered:\n" + str(e))
-
-
-# Convert /etc/passwd and /etc/shadow entries into a list of usernames and dictionary of account info.
+            raise MigrationError("Creating " + LOCK_FILE + " triggered:\n" + str(e),
+                                 EXIT_CODE_FAILURE_TO_OPEN_LOCAL_FILE)
+
+
+# Close a destination's journal if one is open. With statuses given, the journal is also deleted if every action
+# succeeded, leaving nothing to resume.
+def closeJournal(target, statuses=None):
+    with journalLock:
+        journal = actionJournals.pop(target, None)
+    if journal is not None:
+        journal.close()
+    if statuses is not None and not [status for status in statuses if status != 0]:
+        discardJournal(target)
+
+
+# Shut down every master ssh connection and remove their control sockets. Safe to call more than once.
+def closeSshMasters():
+    global sshControlDir
+
+    for target in sshControlPaths.keys():
+        startTime = time.time()
+        runStats.count('sshProcesses')
+        commands.getstatusoutput('ssh -O exit -o ControlPath=' + pipes.quote(sshControlPaths.pop(target)) +
+                                 ' ' + pipes.quote(target))
+        printVerbose("Closed master ssh connection to " + target + " in %.2f seconds." % (time.time() - startTime))
+    if sshControlDir is not None:
+        shutil.rmtree(sshControlDir, ignore_errors=True)
+        sshControlDir = None
+
+
+# Construct a dictionary of Accounts from a snapshot stream: passwd entries, then SNAPSHOT_SEPARATOR, then
+# shadow entries, with any SNAPSHOT_UNCHANGED and STATUS_MARKER lines picked out along the way. Returns the
+# dictionary, the read status reported in the stream (or None) and whether the snapshot was reported unchanged.
+def constructSnapshotDataSet(lines):
+    report = {'status': None, 'unchanged': False}
+
+    def entriesUntil(endMarker):
+        for line in lines:
+            if line == endMarker:
+                return
+            elif line == SNAPSHOT_UNCHANGED:
+                report['unchanged'] = True
+            elif line.startswith(STATUS_MARKER + ' '):
+                report['status'] = int(line.split()[1])
+            else:
+                yield line
+
+    accountDict = constructUserDataSet(entriesUntil(SNAPSHOT_SEPARATOR), entriesUntil(None))
+    return accountDict, report['status'], report['unchanged']
+
+
+# Convert /etc/passwd and /etc/shadow entries into a dictionary of account info keyed by username. The entries
+# can be any iterable of lines, such as an open file, and are read one at a time. Entries outside the regular
+# UID range are dropped before any Account is created for them.
 def constructUserDataSet(passwdEntries, shadowEntries):
-    # Construct user list and preliminary user dictionary from passwd file entries.
-    users, userAccountDict = [], {}
+    # Construct the user dictionary from passwd file entries. The field ordering in passwd and shadow are:
+    #    username:password:userID:groupID:gecos:homeDir:shell
+    #    username:password:lastchanged:minimum:maximum:warn:inactive:expire
+    userAccountDict = {}
     printVerbose("Constructing list of user accounts.")
     for passwdEntry in passwdEntries:
-        account = Account(passwdEntry)
-        if LOWEST_USER_ID <= int(account.uid) <= HIGHEST_USER_ID:  # Ignore irregular users.
-            users.append(account.username)
-            userAccountDict[account.username] = account
+        fields = passwdEntry.rstrip('\n').split(':', 5)
+        if len(fields) < 5 or not fields[2].isdigit():
+            continue
+        if LOWEST_USER_ID <= int(fields[2]) <= HIGHEST_USER_ID:  # Ignore irregular users.
+            userAccountDict[fields[0]] = Account(fields[0], fields[1], fields[2], fields[3], fields[4])
 
     # Replace account password field placeholders with actual passwords from /etc/shadow entries.
     printVerbose("Reading user passwords into account data.")
     for shadowEntry in shadowEntries:
-        shadowFields = shadowEntry.split(':')
-        username, shadowPassword = shadowFields[0], shadowFields[1]
-        if username in userAccountDict:
-            userAccountDict[username].password = shadowPassword
+        shadowFields = shadowEntry.split(':', 2)
+        if len(shadowFields) > 1 and shadowFields[0] in userAccountDict:
+            userAccountDict[shadowFields[0]].password = shadowFields[1].rstrip('\n')
+
+    return userAccountDict
+
+
+# Create groups at a remote machine, copying their names from the local /etc/group, with one ssh call for all of
+# them. Returns the set of GIDs that were created. GIDs that aren't in the local /etc/group can't be created.
+def createRemoteGroups(target, gids):
+    groupNames = getLocalGroups()
+    commandLines = []
+    for gid in sorted(gids):
+        if gid not in groupNames:
+            printLoud("WARNING: Group " + gid + " isn't in " + LOCAL_GROUP_FILE + " so it can't be created.")
+            continue
+        commandLines.append("/usr/sbin/groupadd -g " + gid + " " + pipes.quote(groupNames[gid]) +
+                            " && echo \"" + STATUS_MARKER + " " + gid + "\"")
+    if not commandLines:
+        return set()
+
+    printLoud("Creating " + str(len(commandLines)) + " missing groups.")
+    runStats.count('sshProcesses')
+    status, output = commands.getstatusoutput(sshCommand(target, "; ".join(commandLines)))
+    runStats.count('remoteBytes', len(output))
+    createdGids, messages = set(), []
+    for line in output.split('\n'):
+        if line.startswith(STATUS_MARKER + ' '):
+            createdGids.add(line.split()[1])
+        elif line:
+            messages.append(line)
+    if messages:
+        printLoud("WARNING: Problems creating groups:\n  " + "\n  ".join(messages))
+    if createdGids:
+        logMessage(syslog.LOG_INFO, "Created groups: " + usernameListToLimitedString(sorted(createdGids)))
+    return createdGids
+
+
+# Get a dictionary of the default option values.
+def defaultOptions():
+    return {
+        'batch': False,
+        'jobs': 1,
+        'cache': True,
+        'watch': False,
+        'stats': None,
+        'remoteDiff': False,
+        'bulk': False,
+        'resume': False,
+        'userDatabase': False,
+        'shards': None,
+        'createGroups': False,
+        'maxRuntime': None,
+        'verify': False,
+        'plan': None,
+        'applyPlan': None,
+        'cacheDir': DEFAULT_CACHE_DIR,
+        'unlistedGetDeleted': False,
+        'verbose': False,
+        'simulate': False,
+        'quiet': False,
+        'backupDir': DEFAULT_REMOTE_BACKUP_DIR,
+        'backupsKept': DEFAULT_BACKUPS_KEPT,
+        'port': DEFAULT_SSH_PORT
+    }
+
+
+# Check whether an action should be left for the next run, which is the case for actions below the top priority
+# (migrations) once the run has used up its --max-runtime budget. The budget is measured from the start of the
+# whole run, which shard workers share, rather than from when the current statistics were started.
+def deferAction(action):
+    return ACTION_PRIORITIES[action.kind] > 0 and options['maxRuntime'] is not None and \
+        time.time() - runStartTime >= options['maxRuntime']
+
 
-    return users, userAccountDict
+# Construct the destination shell command that deletes a user account.
+def deleteUserCommand(username):
+    return '/usr/sbin/deluser -quiet ' + username
 
 
-# Create a combined list with no duplicate members (the Python "sets" module is deprecated).
-def createUnionOfLists(listOfLists):
-    itemDictionary = {}
-    for eachList in listOfLists:
-        for item in eachList:
-            itemDictionary[item] = None  # Create a key (the value is irrelevant).
-    return itemDictionary.keys()
+# Construct the path of the local file caching the snapshot of a destination's user accounts.
+def destinationCachePath(target):
+    return os.path.join(options['cacheDir'], 'destination_' + re.sub(r'[^\w.@-]', '_', target) +
+                        '_' + str(options['port']) + shardSuffix())
 
 
-# Delete a user account at a remote machine.
-def deleteRemoteUser(target, username):
-    # Construct and execute command to remotely delete user.
-    cmd = 'ssh -p' + str(options['port']) + ' -n ' + target + ' /usr/sbin/deluser -quiet ' + username
-    executeCommand(cmd)
+# Find the usernames whose compared fields differ between two dictionaries of Accounts, including users that are
+# only in one of them.
+def diffAccountDicts(oldAccountDict, newAccountDict):
+    changedUsers = set()
+    for userName, newAccount in newAccountDict.iteritems():
+        oldAccount = oldAccountDict.get(userName)
+        if oldAccount is None or oldAccount.password != newAccount.password or oldAccount.uid != newAccount.uid or \
+           oldAccount.gid != newAccount.gid or oldAccount.gecos != newAccount.gecos:
+            changedUsers.add(userName)
+    for userName in oldAccountDict:
+        if userName not in newAccountDict:
+            changedUsers.add(userName)
+    return changedUsers
+
+
+# Delete a destination's journal, if there is one.
+def discardJournal(target):
+    try:
+        os.remove(journalPath(target))
+    except OSError:
+        pass
+
+
+# Stream a list of Actions to a remote shell over a single ssh session and return a list of their exit
+# statuses in the same order. Each action is followed by an echo of its exit status and the fingerprint of
+# passwd and shadow tagged with STATUS_MARKER so that results can be matched to actions, and journaled, as the
+# output comes back. The actions are journaled under the given indexes, which default to their positions in the
+# list. With --max-runtime only BATCH_WINDOW actions are sent ahead of the one running, so that migrations are
+# deferred close to the deadline instead of when the script was queued.
+def executeBatch(target, actions, journalIndexes=None):
+    statuses = [ACTION_NO_STATUS] * len(actions)
+    outputs = [[] for action in actions]
+    if not actions:
+        return statuses
+
+    runStats.count('sshProcesses')
+    process = subprocess.Popen(sshArguments(target) + ['sh'],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    window = threading.Semaphore(len(actions) if options['maxRuntime'] is None else BATCH_WINDOW)
+
+    # Feed the script from a separate thread so a full output pipe can never stall the remote shell.
+    def writeScript():
+        try:
+            for index, action in enumerate(actions):
+                window.acquire()
+                if deferAction(action):
+                    statuses[index] = ACTION_DEFERRED
+                    window.release()
+                    continue
+                process.stdin.write('{ ' + action.command + ' ; } </dev/null 2>&1\n' +
+                                    'status=$?; echo "' + STATUS_MARKER + ' ' + str(index) + ' $status $(' +
+                                    FINGERPRINT_COMMAND + ')"\n')
+                process.stdin.flush()
+            process.stdin.close()
+        except IOError:  # The session ended early. Unreported actions keep ACTION_NO_STATUS.
+            pass
+    writer = threading.Thread(target=writeScript)
+    writer.start()
+
+    # Collect output until each status line arrives, then file it under the action it belongs to.
+    pending, lastTime = [], time.time()
+    for line in iter(process.stdout.readline, ''):
+        runStats.count('remoteBytes', len(line))
+        markerPosition = line.find(STATUS_MARKER + ' ')
+        if markerPosition < 0:
+            pending.append(line.rstrip('\n'))
+            continue
+        if markerPosition > 0:
+            pending.append(line[:markerPosition])
+        fields = line[markerPosition:].rstrip('\n').split(None, 3)
+        index, status = int(fields[1]), int(fields[2])
+        statuses[index], outputs[index], pending = status, pending, []
+        journalAction(target, journalIndexes[index] if journalIndexes else index, status,
+                      fields[3] if len(fields) > 3 else None)
+        runStats.latency(time.time() - lastTime)
+        lastTime = time.time()
+        printVerbose("    " + ACTION_VERBS[actions[index].kind] + " user: " + actions[index].username)
+        window.release()
+    for index in range(len(actions)):  # Free the writer if the session ended early.
+        window.release()
+    writer.join()
+    process.wait()
+
+    # Anything printed after the last status line belongs to the first action that never reported back.
+    unreported = [index for index, status in enumerate(statuses) if status == ACTION_NO_STATUS]
+    if unreported:
+        outputs[unreported[0]] = pending + ["ssh session ended with exit code " + str(process.returncode) +
+                                            " before this action reported its status."]
+
+    for index, action in enumerate(actions):
+        if statuses[index] not in (0, ACTION_DEFERRED):
+            printLoud("WARNING: Non-zero exit code on batched command: " + action.command + "\n  " +
+                      "\n  ".join(outputs[index]))
+    return statuses
+
+
+# Perform one Action at a remote machine with its own ssh call, and return its exit status along with the
+# fingerprint of passwd and shadow just after it (None if the action never got to report back). The exit status is
+# the command's own, like the batched and bulk paths report, or ACTION_NO_STATUS if ssh was killed by a signal.
+def executeAction(target, action):
+    runStats.count('sshProcesses')
+    status, output = commands.getstatusoutput(sshCommand(target, action.command + "; status=$?; echo; echo \"" +
+                                                         STATUS_MARKER + " $(" + FINGERPRINT_COMMAND + ")\"; " +
+                                                         "exit $status"))
+    runStats.count('remoteBytes', len(output))
+    status = os.WEXITSTATUS(status) if os.WIFEXITED(status) else ACTION_NO_STATUS
+    lines, fingerprint = output.split('\n'), None
+    if lines[-1].startswith(STATUS_MARKER + ' '):
+        fingerprint = lines.pop()[len(STATUS_MARKER) + 1:]
+        if lines and lines[-1] == '':
+            lines.pop()
+    if status != 0:
+        printLoud("WARNING: Non-zero exit code on command: " + action.command + "\n  " + "\n  ".join(lines))
+    return status, fingerprint
 
 
 # Execute a console command and print results.
 def executeCommand(command):
+    runStats.count('sshProcesses')
     status, output = commands.getstatusoutput(command)
+    runStats.count('remoteBytes', len(output))
     if status != 0:
         printLoud("WARNING: Non-zero exit code on command: " + command + "\n  " + output)
     return status
 
 
-# Get a list of usernames and a dictionary of user data from local machine.
-def getLocalUsers():
-    return getUsers()
+# Quit with the outcome of the destinations' results. A single destination exits the way it always has, while
+# several destinations get a summary of each one.
+def exitWithResults(results):
+    if len(results) == 1:
+        destAddress, exitCode, msg = results[0]
+        if exitCode != EXIT_CODE_SUCCESS:
+            logExit(syslog.LOG_ERR, msg, exitCode)
+    else:
+        printLoud("Destination summary:")
+        failedDestinations = []
+        for destAddress, exitCode, msg in results:
+            printLoud("  " + destAddress + ": exit code " + str(exitCode) + ", " + msg)
+            if exitCode != EXIT_CODE_SUCCESS:
+                failedDestinations.append(destAddress + " (exit code " + str(exitCode) + ")")
+        if failedDestinations:
+            logExit(syslog.LOG_ERR, str(len(failedDestinations)) + " of " + str(len(results)) +
+                    " destinations failed: " + ", ".join(failedDestinations), EXIT_CODE_DESTINATION_FAILED)
+
+
+# Read the in-range entries (in the worker's shard, if sharded) of /etc/passwd and /etc/shadow at a remote machine
+# in a single ssh call. The remote
+# side filters passwd by UID and shadow by the usernames kept from passwd, then gzips both into one stream
+# that ends with the exit status of the read, so a failed read can't pass for an empty file. The stream
+# starts with a fingerprint of both files, and if it equals cachedFingerprint the entries aren't sent at
+# all. The destination's GIDs are read along the way (see recordGroups()).
+# Returns the fingerprint and a dictionary of Accounts (None if the cache is still current).
+def fetchRemoteAccounts(target, cachedFingerprint=None):
+    lowestUid, highestUid = shardUidRange()
+    script = remoteSnapshotScript("awk -F: -v low=" + str(lowestUid) + " -v high=" + str(highestUid) +
+                                  " '" + "FNR == 1 && NR != 1 { print \"" + SNAPSHOT_SEPARATOR + "\" } " +
+                                  "NR == FNR { if ($3 + 0 >= low && $3 + 0 <= high) { kept[$1] = 1; print } next } " +
+                                  "$1 in kept' /etc/passwd /etc/shadow", cachedFingerprint, groups=True)
+    runStats.count('sshProcesses')
+    process = subprocess.Popen(sshArguments(target)[:-1] + ['-n', target, script], stdout=subprocess.PIPE)
+
+    # Decompress the stream and parse accounts out of it as it arrives.
+    lines = readCompressedLines(process.stdout)
+    fingerprint = next(lines, '')
+    recordGroups(target, next(lines, ''))
+    accountDict, readStatus, unchanged = constructSnapshotDataSet(lines)
+    process.wait()
+
+    if process.returncode != 0 or readStatus != 0:
+        raise MigrationError("Unable to read /etc/passwd and /etc/shadow at " + target + " (ssh exit code " +
+                             str(process.returncode) + ", read exit code " + str(readStatus) + ").",
+                             EXIT_CODE_UNABLE_TO_READ_REMOTE)
+
+    if unchanged:
+        return fingerprint, None
+    return fingerprint, accountDict
+
+
+# Read a remote machine's accounts like fetchRemoteAccounts(), but for --remote-diff mode: only a digest of each
+# account crosses the network at first, and full entries are fetched just for the accounts whose digest doesn't
+# match their local account (changed or remote-only accounts). Accounts that match are filled in from the local
+# ones, since their compared fields are the same.
+def fetchRemoteAccountsByDigest(target, srcAccountDict, cachedFingerprint=None):
+    fingerprint, digestDict = fetchRemoteDigests(target, cachedFingerprint)
+    if digestDict is None:
+        return fingerprint, None
+
+    accountDict, mismatchedUsers = {}, []
+    for username, (uid, gid, digest) in digestDict.iteritems():
+        srcAccount = srcAccountDict.get(username)
+        if srcAccount is not None and accountDigest(srcAccount) == digest:
+            accountDict[username] = Account(username, srcAccount.password, uid, gid, srcAccount.gecos)
+        else:
+            mismatchedUsers.append(username)
+    runStats.count('digestMismatches', len(mismatchedUsers))
+    printVerbose(str(len(accountDict)) + " of " + str(len(digestDict)) + " remote accounts match local ones, " +
+                 "fetching the other " + str(len(mismatchedUsers)) + ".")
+
+    if mismatchedUsers:
+        rowsFingerprint, rowsAccountDict = fetchRemoteRows(target, mismatchedUsers)
+        if rowsFingerprint != fingerprint or len(rowsAccountDict) != len(mismatchedUsers):
+            # The destination changed between the two reads, so fall back to reading everything at once.
+            printVerbose("Remote accounts changed while being read, fetching all of them.")
+            return fetchRemoteAccounts(target)
+        accountDict.update(rowsAccountDict)
+    return fingerprint, accountDict
+
+
+# Get the fingerprint of a remote machine's /etc/passwd and /etc/shadow and a dictionary of [uid, gid, digest]
+# for each of its in-range accounts (in the worker's shard, if sharded), keyed by username. The digests are None if the fingerprint equals
+# cachedFingerprint.
+def fetchRemoteDigests(target, cachedFingerprint=None):
+    lowestUid, highestUid = shardUidRange()
+    script = remoteSnapshotScript(remotePerlCommand(REMOTE_DIGEST_HELPER, "digests " + str(lowestUid) + " " +
+                                                    str(highestUid) + " " + SNAPSHOT_SEPARATOR + " " +
+                                                    str(DIGEST_LENGTH)), cachedFingerprint, groups=True)
+    runStats.count('sshProcesses')
+    process = subprocess.Popen(sshArguments(target)[:-1] + ['-n', target, script], stdout=subprocess.PIPE)
+
+    lines = readCompressedLines(process.stdout)
+    fingerprint = next(lines, '')
+    recordGroups(target, next(lines, ''))
+    digestDict, readStatus, unchanged = {}, None, False
+    for line in lines:
+        if line == SNAPSHOT_UNCHANGED:
+            unchanged = True
+        elif line.startswith(STATUS_MARKER + ' '):
+            readStatus = int(line.split()[1])
+        else:
+            fields = line.split(':')
+            if len(fields) == 4:
+                digestDict[fields[0]] = fields[1:]
+    process.wait()
+
+    if readStatus == PERL_MISSING_STATUS:
+        raise perlMissingError(target)
+    if process.returncode != 0 or readStatus != 0:
+        raise MigrationError("Unable to read account digests at " + target + " (ssh exit code " +
+                             str(process.returncode) + ", read exit code " + str(readStatus) + ").",
+                             EXIT_CODE_UNABLE_TO_READ_REMOTE)
+
+    if unchanged:
+        return fingerprint, None
+    return fingerprint, digestDict
+
+
+# Look up the passwd and shadow entries of only the given users at a remote machine with getent, so that the
+# lookups see what the system's name service sees, and return a dictionary of their Accounts. Users that don't
+# exist there are left out. The usernames are sent over the ssh session's input and looked up in one call. getent
+# exits with 2 when a user isn't found, which is expected, but any other failure (such as getent missing) is
+# reported on the status line, since every user would seem absent.
+def fetchRemoteEntries(target, usernames):
+    lookup = "xargs -r sh -c '/usr/bin/getent %s \"$@\" || [ $? -eq 2 ]' sh"
+    command = "users=$(cat); echo \"$users\" | " + lookup % 'passwd' + "; status=$?; echo " + SNAPSHOT_SEPARATOR + \
+              "; echo \"$users\" | " + lookup % 'shadow' + "; shadowStatus=$?; " + \
+              "[ $status -ne 0 ] || status=$shadowStatus; echo \"" + STATUS_MARKER + " $status\""
+    runStats.count('sshProcesses')
+    process = subprocess.Popen(sshArguments(target) + [command], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output = process.communicate(''.join([username + '\n' for username in usernames]))[0]
+    runStats.count('remoteBytes', len(output))
+
+    accountDict, readStatus, unchanged = constructSnapshotDataSet(output.splitlines())
+    if process.returncode != 0 or readStatus != 0:
+        raise MigrationError("Unable to look up accounts at " + target + " (ssh exit code " +
+                             str(process.returncode) + ", getent exit code " + str(readStatus) + ").",
+                             EXIT_CODE_UNABLE_TO_READ_REMOTE)
+    return accountDict
+
+
+# Get the fingerprint of /etc/passwd and /etc/shadow at a remote machine without reading either file.
+def fetchRemoteFingerprint(target):
+    runStats.count('sshProcesses')
+    status, output = commands.getstatusoutput(sshCommand(target, FINGERPRINT_COMMAND))
+    runStats.count('remoteBytes', len(output))
+    if status != 0:
+        return None
+    return output
+
 
+# Read the passwd and shadow entries of only the given users at a remote machine, and return the fingerprint of
+# both files along with a dictionary of their Accounts. The usernames are sent over the ssh session's input.
+def fetchRemoteRows(target, usernames):
+    script = remoteSnapshotScript(remotePerlCommand(REMOTE_DIGEST_HELPER, "rows " + str(LOWEST_USER_ID) + " " +
+                                                    str(HIGHEST_USER_ID) + " " + SNAPSHOT_SEPARATOR + " " +
+                                                    str(DIGEST_LENGTH)))
+    runStats.count('sshProcesses')
+    process = subprocess.Popen(sshArguments(target) + [script], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
 
-# Get a list of usernames and a dictionary of user data from remote machine.
-def getRemoteUsers(target):
-    return getUsers(target)
+    # Send the usernames from a separate thread so that neither side's pipe can fill up and stall the other.
+    def writeUsernames():
+        try:
+            for username in usernames:
+                process.stdin.write(username + '\n')
+            process.stdin.close()
+        except IOError:
+            pass
+    writer = threading.Thread(target=writeUsernames)
+    writer.start()
+
+    lines = readCompressedLines(process.stdout)
+    fingerprint = next(lines, '')
+    accountDict, readStatus, unchanged = constructSnapshotDataSet(lines)
+    writer.join()
+    process.wait()
+
+    if readStatus == PERL_MISSING_STATUS:
+        raise perlMissingError(target)
+    if process.returncode != 0 or readStatus != 0:
+        raise MigrationError("Unable to read /etc/passwd and /etc/shadow at " + target + " (ssh exit code " +
+                             str(process.returncode) + ", read exit code " + str(readStatus) + ").",
+                             EXIT_CODE_UNABLE_TO_READ_REMOTE)
+    return fingerprint, accountDict
+
+
+# Get the set of listed users from USER LIST FILE, which is either a text file with one username per line or,
+# with --user-database, the VCN user database. With blocking set, wait for the database's lock instead of
+# quitting. Changes to the list since the last run are reported, and the list is kept for the next run.
+def getListedUsers(userListFilename, blocking=False):
+    if options['userDatabase']:
+        listedUsers = readUserDatabase(userListFilename, blocking)
+    else:
+        listedUsers = set(textFileIntoLines(userListFilename))
 
+    lastListedUsers = loadListedUsers()
+    if lastListedUsers is not None and lastListedUsers != listedUsers:
+        printVerbose(str(len(listedUsers - lastListedUsers)) + " users were added to and " +
+                     str(len(lastListedUsers - listedUsers)) + " removed from the list since it was last read.")
+    if lastListedUsers != listedUsers:
+        saveListedUsers(listedUsers)
+    return listedUsers
 
-# Read /etc/passwd and /etc/shadow files to produce a list of the non-system usernames
-# present on a system and a dictionary of Accounts keyed by username.
+
+# Get a dictionary of the group names in the local /etc/group keyed by GID.
+def getLocalGroups():
+    try:
+        with open(LOCAL_GROUP_FILE, 'r') as groupFile:
+            groupNames = {}
+            for groupEntry in groupFile:
+                fields = groupEntry.rstrip('\n').split(':')
+                if len(fields) >= 3:
+                    groupNames.setdefault(fields[2], fields[0])
+            return groupNames
+    except IOError as e:
+        printLoud("WARNING: Unable to read " + LOCAL_GROUP_FILE + ". " + str(e))
+        return {}
+
+
+# Get a dictionary of user data from local machine.
+def getLocalUsers():
+    return getUsers()
+
+
+# Get a dictionary of user data from remote machine, and whether it is an unchanged cached snapshot. If the
+# snapshot kept in memory or in the cache file is still current then only its fingerprint crosses the network.
+# In --remote-diff mode the remote accounts are compared to srcAccountDict by digest, and only the ones that
+# differ are read in full. With loadSnapshot unset an unchanged snapshot that isn't in memory isn't read from its
+# cache file either, and None is returned in its place.
+def getRemoteUsers(target, srcAccountDict=None, loadSnapshot=True):
+    cachedFingerprint = None
+    if options['cache'] and target in destinationSnapshots:
+        cachedFingerprint = destinationSnapshots[target][0]
+    elif options['cache']:
+        cachedFingerprint = loadDestinationCacheFingerprint(target)
+
+    if options['remoteDiff'] and srcAccountDict is not None:
+        fingerprint, accountDict = fetchRemoteAccountsByDigest(target, srcAccountDict, cachedFingerprint)
+    else:
+        fingerprint, accountDict = fetchRemoteAccounts(target, cachedFingerprint)
+    remoteFingerprints[target] = fingerprint
+    if accountDict is None:
+        printVerbose("Destination is unchanged since the last run, using the cached snapshot.")
+        if target not in destinationSnapshots:
+            if not loadSnapshot:
+                return None, True
+            destinationSnapshots[target] = (fingerprint, loadDestinationCache(target))
+        return destinationSnapshots[target][1], True
+
+    if options['cache'] and not options['simulate']:
+        saveDestinationCache(target, fingerprint, accountDict)
+    return accountDict, False
+
+
+# Read /etc/passwd and /etc/shadow files to produce a dictionary of Accounts of the non-system
+# users present on a system keyed by username.
 def getUsers(target=None):
     global options
 
-    # Get file handles.
-    if target is None:  # If no target was given then open local files.
-        try:
-            passwdFile = open('/etc/passwd', 'r')
-            shadowFile = open('/etc/shadow', 'r')
+    # If a remote target was given then fetch the remote entries in one round trip.
+    if target is not None:
+        fingerprint, accountDict = fetchRemoteAccounts(target)
+        return accountDict
+
+    # If no target was given then stream the local files line by line.
+    try:
+        with open(LOCAL_PASSWD_FILE, 'r') as passwdFile:
+            with open(LOCAL_SHADOW_FILE, 'r') as shadowFile:
+                return constructUserDataSet(passwdFile, shadowFile)
+
+    except IOError as e:
+        raise MigrationError("Unable to open local file.\n" + str(e), EXIT_CODE_FAILURE_TO_OPEN_LOCAL_FILE)
+
+
+# Split a list of Actions into lanes: lists of action indexes that must run one after another because they
+# involve the same username or the same UID. Within a lane an action that releases a UID runs before any
+# action that claims it (so a UID change or deletion clears the way for an add), otherwise actions go by
+# priority (see ACTION_PRIORITIES) and then their original order. Separate lanes share nothing and can safely run
+# in parallel.
+def groupActionsIntoLanes(actions):
+    # Join actions that share a username or UID using a union-find over the shared keys.
+    parents = {}
+
+    def findRoot(key):
+        while parents.setdefault(key, key) != key:
+            parents[key] = parents[parents[key]]
+            key = parents[key]
+        return key
+
+    for index, action in enumerate(actions):
+        for key in [('uid', action.claims), ('uid', action.releases)]:
+            if key[1] is not None:
+                parents[findRoot(key)] = findRoot(('user', action.username))
+
+    laneDict = {}
+    for index, action in enumerate(actions):
+        laneDict.setdefault(findRoot(('user', action.username)), []).append(index)
+
+    # Order each lane so that UIDs are released before they are claimed.
+    lanes = []
+    for lane in sorted(laneDict.values()):
+        releasers = {}
+        for index in lane:
+            if actions[index].releases is not None:
+                releasers.setdefault(actions[index].releases, []).append(index)
+        waitCounts, followers = dict.fromkeys(lane, 0), dict([(index, []) for index in lane])
+        for index in lane:
+            for releaser in releasers.get(actions[index].claims, []):
+                if releaser != index:
+                    waitCounts[index] += 1
+                    followers[releaser].append(index)
+
+        orderedLane, ready = [], [(ACTION_PRIORITIES[actions[index].kind], index) for index in lane
+                                  if waitCounts[index] == 0]
+        heapq.heapify(ready)
+        while ready:
+            priority, index = heapq.heappop(ready)
+            orderedLane.append(index)
+            for follower in followers[index]:
+                waitCounts[follower] -= 1
+                if waitCounts[follower] == 0:
+                    heapq.heappush(ready, (ACTION_PRIORITIES[actions[follower].kind], follower))
+
+        # Circular UID swaps can't be ordered. Run them last in their original order and let them fail.
+        orderedLane += [index for index in lane if waitCounts[index] > 0]
+        lanes.append(orderedLane)
+
+    return lanes
+
+
+# Append the outcome of an action to its destination's journal, if one is open, along with the fingerprint of
+# passwd and shadow just after it, which is also remembered for updateDestinationCache(). When several lanes run
+# at once another lane's action may land between an action and its fingerprint, so the fingerprint is left out
+# of the journal and --resume won't trust it.
+def journalAction(target, index, status, fingerprint):
+    with journalLock:
+        if fingerprint is not None:
+            actionFingerprints[target] = fingerprint
+    if target not in actionJournals:
+        return
+    if options['jobs'] > 1:
+        fingerprint = None
+    with journalLock:
+        record = {'index': index, 'status': status, 'fingerprint': fingerprint}
+        actionJournals[target].write(json.dumps(record, sort_keys=True) + '\n')
+        actionJournals[target].flush()
+
+
+# Get the path of the journal that records the progress of the actions applied to a destination. Journals are
+# kept next to LOCK_FILE.
+def journalPath(target):
+    return os.path.splitext(LOCK_FILE)[0] + '_' + re.sub(r'[^\w.@-]', '_', target) + '_' + \
+        str(options['port']) + shardSuffix() + '.journal'
+
+
+# Read the cached snapshot of a destination into a dictionary of Accounts keyed by username.
+def loadDestinationCache(target):
+    with open(destinationCachePath(target), 'r') as cacheFile:
+        cacheFile.readline()  # Skip the fingerprint.
+        return constructSnapshotDataSet(line.rstrip('\n') for line in cacheFile)[0]
+
+
+# Read the fingerprint that the cached snapshot of a destination is valid for. A missing or unreadable cache
+# gives None, which never matches the destination.
+def loadDestinationCacheFingerprint(target):
+    try:
+        with open(destinationCachePath(target), 'r') as cacheFile:
+            return cacheFile.readline().rstrip('\n') or None
+    except IOError:
+        return None
 
-        except IOError as e:
-            logExit(syslog.LOG_ERR, "Unable to open local file.\n" +
-                    str(e), EXIT_CODE_FAILURE_TO_OPEN_LOCAL_FILE)
 
-    else:  # If a remote target was given then open remote files.
-        passwdFile = subprocess.Popen(['ssh', '-p', str(options['port']), target, 'cat', '/etc/passwd'], stdout=subprocess.PIPE).stdout
-        shadowFile = subprocess.Popen(['ssh', '-p', str(options['port']), target, 'cat', '/etc/shadow'], stdout=subprocess.PIPE).stdout
+# Label the file keeping the users listed on the last run (see saveListedUsers()) by its inode, size and mtime, which
+# all change whenever it is rewritten.
+def listedUsersLabel():
+    return json.dumps(statFiles([os.path.join(options['cacheDir'], LISTED_USERS_FILE)]))
 
-    # Split text files into lists of lines.
-    passwdEntries = passwdFile.read().splitlines()
-    shadowEntries = shadowFile.read().splitlines()
 
-    return constructUserDataSet(passwdEntries, shadowEntries)
+# Read the set of users listed on the last run, or None if it isn't known.
+def loadListedUsers():
+    if not options['cache']:
+        return None
+    try:
+        with open(os.path.join(options['cacheDir'], LISTED_USERS_FILE), 'r') as listFile:
+            return set(listFile.read().splitlines())
+    except IOError:
+        return None
+
+
+# Read the local index (see saveLocalIndex()) and return its label along with, if readDigests is set, its
+# dictionary of account digests. Gives (None, None) if there is no readable index.
+def loadLocalIndex(readDigests=True):
+    try:
+        with open(os.path.join(options['cacheDir'], LOCAL_INDEX_FILE), 'r') as indexFile:
+            label = indexFile.readline().rstrip('\n') or None
+            digests = dict(line.split() for line in indexFile) if readDigests else None
+            return label, digests
+    except (IOError, ValueError):
+        return None, None
+
+
+# Get the local accounts for a run that started without them (see scanLocalChanges()). They are parsed by the
+# first destination that needs them and shared with the rest.
+def loadLocalUsers():
+    global localAccounts
+
+    with localAccountsLock:
+        if localAccounts is None:
+            printVerbose("Loading local users...")
+            with runStats.phase('parseSource'):
+                localAccounts = getLocalUsers()
+        return localAccounts
+
+
+# Read the state a destination was last brought fully in sync from (see saveSyncState()), or None if it isn't known.
+def loadSyncState(target):
+    try:
+        with open(destinationCachePath(target) + '.synced', 'r') as stateFile:
+            return json.load(stateFile)
+    except (IOError, ValueError):
+        return None
 
 
-# Lock out execution of multiple instances.
-def lockExecution():
+# Lock out execution of multiple instances. With blocking set, wait for the lock instead of quitting. Sharded runs
+# take the lock shared, so that runs on different shards can go at the same time (see lockShard()), while still
+# locking out unsharded runs and other programs using the lock.
+def lockExecution(blocking=False, shared=False):
     global lockFile, LOCK_FILE
 
     try:
         lockFile = open(LOCK_FILE, 'w')
-        fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        lockType = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if blocking:
+            fcntl.flock(lockFile, lockType)
+        else:
+            fcntl.flock(lockFile, lockType | fcntl.LOCK_NB)
 
     except IOError as e:
         if e[0] == 11:
-            logExit(syslog.LOG_ERR, "Execution has been locked out by another program or " +
-                    "another instance of this program.", EXIT_CODE_INSTANCE_ALREADY_RUNNING)
+            raise MigrationError("Execution has been locked out by another program or " +
+                                 "another instance of this program.", EXIT_CODE_INSTANCE_ALREADY_RUNNING)
         else:
-            logExit(syslog.LOG_ERR, "Locking " + LOCK_FILE + " triggered:\n" + str(e))
+            raise MigrationError("Locking " + LOCK_FILE + " triggered:\n" + str(e),
+                                 EXIT_CODE_FAILURE_TO_OPEN_LOCAL_FILE)
+
+
+# Lock this worker's shard: the bytes of SHARD_LOCK_FILE at the offsets of the shard's UIDs, so that runs with
+# overlapping shards exclude each other however their shards were split. Returns whether the lock was taken.
+def lockShard():
+    global shardLockFile
+
+    lowestUid, highestUid = shard
+    try:
+        shardLockFile = open(SHARD_LOCK_FILE, 'a')
+        fcntl.lockf(shardLockFile, fcntl.LOCK_EX | fcntl.LOCK_NB, highestUid - lowestUid + 1, lowestUid)
+        return True
+    except IOError as e:
+        if e[0] not in (11, 13):
+            printLoud("WARNING: Locking " + SHARD_LOCK_FILE + " triggered:\n" + str(e))
+        return False
+
+
+# Lock the bytes of SHARD_LOCK_FILE of UIDs in other shards, waiting for the workers (or other runs) holding them to
+# finish, so that accounts can be moved onto those UIDs only after the other shards have freed them. The workers of
+# this run are first given the chance to lock their own shards. Returns whether the locks were taken, which they
+# aren't if waiting would deadlock with a worker waiting for this one's shard.
+def lockShardUids(uids):
+    for uid in sorted(set(uids)):
+        for shardRange, lockedEvent in shardLockEvents:
+            if shardRange[0] <= uid <= shardRange[1]:
+                lockedEvent.wait()
+        try:
+            fcntl.lockf(shardLockFile, fcntl.LOCK_EX, 1, uid)
+        except IOError as e:
+            if e[0] != 35:
+                printLoud("WARNING: Locking " + SHARD_LOCK_FILE + " triggered:\n" + str(e))
+            return False
+    return True
 
 
 # Log a message to syslog and quit. Exiting with a single message ensures that the program will never flood the syslog
@@ -226,6 +1553,7 @@ def logExit(priority, msg, exitCode):
 
     printLoud(msg)
 
+    closeSshMasters()
     exit(exitCode)
 
 
@@ -234,16 +1562,262 @@ def logExit(priority, msg, exitCode):
 def logMessage(priority, msg):
     assert priority == syslog.LOG_INFO or priority == syslog.LOG_WARNING
     if not options['simulate']:
-        syslog.syslog(priority, msg)
+        syslog.syslog(priority, getattr(threadState, 'prefix', '') + msg)
 
     printLoud(msg)
 
 
+# Log the users whose migrations were skipped because their groups don't exist at the destination.
+def logSkippedMigrations(skippedUsers):
+    logMessage(syslog.LOG_WARNING, "Skipped migrations: " + usernameListToLimitedString(skippedUsers) +
+               ". Their groups don't exist at destination (use --create-groups to create them).")
+
+
+# Convert the value given to a numeric command-line option, or quit with EXIT_CODE_BAD_OPTIONS if it isn't a number.
+def numericOption(option, value, convert=int):
+    try:
+        return convert(value)
+    except ValueError:
+        printLoud("Invalid " + option + " " + value + ": expected a number.")
+        exit(EXIT_CODE_BAD_OPTIONS)
+
+
+# Start watching files for changes and return a watcher for waitForFileChanges(). Linux inotify is used through
+# ctypes when it is available: the directories holding the files are watched, since tools like passwd replace
+# files rather than rewrite them. Otherwise the watcher falls back to comparing os.stat() results.
+def openFileWatcher(paths):
+    paths = [os.path.abspath(path) for path in paths]
+    watcher = {'fd': None, 'paths': paths, 'names': set([os.path.basename(path) for path in paths]),
+               'stats': statFiles(paths)}
+
+    libcName = ctypes.util.find_library('c')
+    if libcName is not None:
+        libc = ctypes.CDLL(libcName, use_errno=True)
+        if hasattr(libc, 'inotify_init') and hasattr(libc, 'inotify_add_watch'):
+            fd = libc.inotify_init()
+            if fd >= 0:
+                for directory in set([os.path.dirname(path) for path in paths]):
+                    if libc.inotify_add_watch(fd, directory, INOTIFY_EVENTS) < 0:
+                        os.close(fd)
+                        fd = -1
+                        break
+            if fd >= 0:
+                watcher['fd'] = fd
+
+    if watcher['fd'] is None:
+        printVerbose("inotify is unavailable, checking watched files every " + str(WATCH_POLL_INTERVAL) + " seconds.")
+    return watcher
+
+
+# Start a destination's journal: a JSON line with the fingerprint of passwd and shadow before any of the actions,
+# then a plan record (see writePlan()) for each action. journalAction() then appends a line as each action
+# finishes. No password hashes are written. A journal that can't be written only costs the ability to resume.
+def openJournal(target, actions, fingerprint):
+    closeJournal(target)
+    try:
+        journal = open(journalPath(target), 'w')
+        journal.write(json.dumps({'destination': target, 'fingerprint': fingerprint}, sort_keys=True) + '\n')
+        for action in actions:
+            destinationUid = action.releases
+            if destinationUid is None and action.kind == 'update':
+                destinationUid = action.account.uid
+            journal.write(json.dumps({'destination': target, 'user': action.username, 'action': action.kind,
+                                      'uid': action.account and action.account.uid,
+                                      'sourceDigest': action.account and accountDigest(action.account),
+                                      'destinationUid': destinationUid}, sort_keys=True) + '\n')
+        journal.flush()
+        actionJournals[target] = journal
+    except IOError as e:
+        printLoud("WARNING: Unable to write journal " + journalPath(target) + ". " + str(e))
+
+
+# Open a master ssh connection to a remote machine that every later ssh call to it will share, so that
+# the handshake and key exchange are only paid once per run. This doubles as the connection test and
+# returns the exit status and output of the connection attempt.
+def openSshMaster(target):
+    global sshControlDir
+
+    with sshControlLock:
+        if sshControlDir is None:
+            sshControlDir = tempfile.mkdtemp(prefix='pymigrate-ssh-')
+            atexit.register(closeSshMasters)
+        sshControlPaths[target] = os.path.join(sshControlDir, 'master-' + hashlib.md5(target).hexdigest()[:12])
+
+    startTime = time.time()
+    runStats.count('sshProcesses')
+    arguments = sshArguments(target)[:-1] + ['-o', 'BatchMode=yes', target, 'exit']
+    status, output = commands.getstatusoutput(' '.join([pipes.quote(argument) for argument in arguments]))
+    if status != 0:
+        del sshControlPaths[target]
+    else:
+        printVerbose("Opened master ssh connection to " + target + " in %.2f seconds." % (time.time() - startTime))
+    return status, output
+
+
+# Split the managed UID range into shards for the --shards option, given either a count of equal shards or a comma
+# separated list of LOW-HIGH ranges, and return a list of (lowest UID, highest UID) pairs. Raises a ValueError if
+# the specification is invalid, the ranges overlap or they leave the managed range.
+def parseShards(specification):
+    if specification.isdigit():
+        count = int(specification)
+        if not 0 < count <= HIGHEST_USER_ID - LOWEST_USER_ID + 1:
+            raise ValueError("invalid shard count " + specification)
+        size = (HIGHEST_USER_ID - LOWEST_USER_ID + 1) // count
+        bounds = [LOWEST_USER_ID + size * i for i in range(count)] + [HIGHEST_USER_ID + 1]
+        return [(bounds[i], bounds[i + 1] - 1) for i in range(count)]
+
+    shards = []
+    for shardRange in specification.split(','):
+        lowestUid, highestUid = [int(uid) for uid in shardRange.split('-')]
+        if not LOWEST_USER_ID <= lowestUid <= highestUid <= HIGHEST_USER_ID:
+            raise ValueError("shard " + shardRange + " isn't within " + str(LOWEST_USER_ID) + "-" +
+                             str(HIGHEST_USER_ID))
+        shards.append((lowestUid, highestUid))
+    shards.sort()
+    for previous, following in zip(shards, shards[1:]):
+        if following[0] <= previous[1]:
+            raise ValueError("shards overlap")
+    return shards
+
+
+# Back up a destination's passwd and shadow files, apply a list of Actions to it, bring its cached snapshot up to
+# date and log a summary of what succeeded and failed. If destAccountDict is None then the destination's accounts
+# weren't read (such as when applying a saved plan) and its cache is dropped instead. With --verify the touched
+# users are then looked up at the destination (see verifyActions()). Raises a MigrationError if the backup fails
+# or if any user didn't converge.
+def performActions(destAddress, actions, srcAccountDict, destAccountDict):
+    # Backup the user files before making changes, unless that was done while reading the destination's groups.
+    with runStats.phase('backup'):
+        backupStatus, backupName = remoteBackups.pop(destAddress, (None, None))
+        if backupStatus is None:
+            printLoud("Backing up passwd and shadow to " + options['backupDir'])
+            backupStatus, backupName = executeCommand(sshCommand(destAddress, backupCommand())), None
+
+        # Give up on this destination if unable to backup.
+        if backupStatus != 0:
+            raise MigrationError("Unable to create remote backup of /etc/passwd and /etc/shadow in " +
+                                 options['backupDir'] + ".", EXIT_CODE_UNABLE_TO_BACKUP)
+        if backupName is not None:
+            printLoud("Backed up passwd and shadow to " + options['backupDir'] + "/" + backupName)
+
+    # Apply every action in one pass, either one ssh call at a time or batched, journaling each as it finishes.
+    printLoud("Applying " + str(len(actions)) + " user changes.")
+    with runStats.phase('apply'):
+        actionFingerprints[destAddress] = remoteFingerprints.pop(destAddress, None) or \
+            fetchRemoteFingerprint(destAddress)
+        openJournal(destAddress, actions, actionFingerprints[destAddress])
+        statuses = None
+        try:
+            statuses = applyActions(destAddress, actions)
+        finally:
+            closeJournal(destAddress, statuses)
+
+    # Check that the changes took, looking up only the users they touched. If the lookup fails then the error is
+    # raised after the summary, since the changes were made all the same.
+    unconvergedUsers, verifyError = [], None
+    if options['verify']:
+        with runStats.phase('verify'):
+            try:
+                unconvergedUsers = verifyActions(destAddress, actions, statuses)
+            except MigrationError as e:
+                verifyError = e
+
+    # Sort the results into what succeeded, what didn't and what was left for the next run.
+    succeeded = {'migrate': [], 'delete': [], 'update': []}
+    failed = {'migrate': [], 'delete': [], 'update': []}
+    deferred = {'migrate': [], 'delete': [], 'update': []}
+    for action, status in zip(actions, statuses):
+        if status == 0:
+            succeeded[action.kind].append(action.username)
+        elif status == ACTION_DEFERRED:
+            deferred[action.kind].append(action.username)
+        else:
+            failed[action.kind].append(action.username)
+    destinationOutcomes[destAddress] = (succeeded, failed, deferred)
+    migratingUsers, doomedUsers, updatingUsers = succeeded['migrate'], succeeded['delete'], succeeded['update']
+    failedUsers = failed['migrate']
+    with runStats.phase('cacheUpdate'):
+        updateDestinationCache(destAddress, destAccountDict, srcAccountDict, actions, statuses)
+
+    printLoud("The following summary will be recorded in syslog:")
+    if migratingUsers:
+        logMessage(syslog.LOG_INFO, "Migrated users: " + usernameListToLimitedString(migratingUsers))
+    if doomedUsers:
+        logMessage(syslog.LOG_INFO, "Deleted users: " + usernameListToLimitedString(doomedUsers))
+    if updatingUsers:
+        logMessage(syslog.LOG_INFO, "Updated users: " + usernameListToLimitedString(updatingUsers))
+    if failedUsers:
+        logMessage(syslog.LOG_WARNING, "Failed migrations: " +
+                   usernameListToLimitedString(failedUsers) + ". Maybe their group wasn't " +
+                   "found at destination.")
+    if failed['delete']:
+        logMessage(syslog.LOG_WARNING, "Failed deletions: " + usernameListToLimitedString(failed['delete']))
+    if failed['update']:
+        logMessage(syslog.LOG_WARNING, "Failed updates: " + usernameListToLimitedString(failed['update']))
+    if deferred['migrate']:
+        logMessage(syslog.LOG_WARNING, "Deferred migrations: " + usernameListToLimitedString(deferred['migrate']) +
+                   ". The run's %g second budget ran out, so they are left for the next run." % options['maxRuntime'])
+    if verifyError is not None:
+        raise verifyError
+    if unconvergedUsers:
+        raise MigrationError("Users didn't converge at destination: " +
+                             usernameListToLimitedString(unconvergedUsers), EXIT_CODE_UNCONVERGED)
+
+
+# Perform actions that were decided without reading the destination's accounts (from a saved plan or an
+# interrupted run's journal). The destination is backed up and its GIDs read first, so that migrations into groups
+# that don't exist there are skipped, or the groups created with --create-groups, as when synchronizing.
+def performPlannedActions(destAddress, actions, srcAccountDict):
+    if actions:
+        backupRemoteAndReadGroups(destAddress)
+    skippedUsers = checkDestinationGroups(destAddress, [action.username for action in actions
+                                                        if action.kind == 'migrate'], srcAccountDict)[1]
+    if skippedUsers:
+        logSkippedMigrations(skippedUsers)
+        actions = [action for action in actions if action.kind != 'migrate' or action.username not in skippedUsers]
+
+    if actions:
+        performActions(destAddress, actions, srcAccountDict, None)
+    else:
+        printLoud("No user changes need to be made.")
+    if skippedUsers:
+        destinationOutcomes.setdefault(destAddress, ({}, {}, {}))[1].setdefault('migrate', []).extend(skippedUsers)
+
+
+# Construct the error for a destination that lacks perl, which the --remote-diff, --bulk and --shards helpers run
+# with there.
+def perlMissingError(target):
+    return MigrationError("perl isn't installed at " + target + ", which --remote-diff, --bulk and --shards need.",
+                          EXIT_CODE_UNABLE_TO_READ_REMOTE)
+
+
+# Go through every user a destination's categorization concerns and yield (category, username) pairs, where the
+# category is one of 'migrate', 'delete', 'update', 'missing' (listed but not found locally), 'missingGroup'
+# (would be migrated but its group doesn't exist at the destination) or 'ignore' (left as it is). Every user is
+# given exactly once.
+def planRecords(listedUsers, srcAccountDict, destAccountDict, missingUsers, migratingUsers, doomedUsers,
+                updatingUsers, groupMissingUsers=()):
+    seenUsers = set()
+    for category, userNames in (('migrate', migratingUsers), ('delete', doomedUsers), ('update', updatingUsers),
+                                ('missingGroup', groupMissingUsers), ('missing', missingUsers)):
+        for userName in userNames:
+            seenUsers.add(userName)
+            yield category, userName
+
+    # Ignored users = all users - changed users.
+    for userDict in (listedUsers, srcAccountDict, destAccountDict):
+        for userName in userDict:
+            if userName not in seenUsers:
+                seenUsers.add(userName)  # Only list each ignored user once.
+                yield 'ignore', userName
+
+
 def printHelpMessage():
     print """
-Usage: ./migrate.py [OPTIONS]... [DESTINATION] [USER LIST FILE]
+Usage: ./migrate.py [OPTIONS]... [DESTINATION]... [USER LIST FILE]
+   or: ./migrate.py [OPTIONS]... --apply [PLAN FILE]
 
-Transfer/update user accounts specified in USER LIST FILE to the DESTINATION computer and delete users at the destination that no longer exist locally. The USER LIST FILE must contain a new-line separated list of usernames. Changed passwords are the only attribute that will be propagated and this will occur regardless of whether that user is in the USER LIST FILE.
+Transfer/update user accounts specified in USER LIST FILE to the DESTINATION computer and delete users at the destination that no longer exist locally. Several DESTINATIONs can be given, in which case they are all synchronized at the same time from a single reading of the local accounts and USER LIST FILE. The USER LIST FILE must contain a new-line separated list of usernames. Changed passwords are the only attribute that will be propagated and this will occur regardless of whether that user is in the USER LIST FILE.
 
   --help                      display this message and quit
   -u, --unlisted-get-deleted  removing a user from USER LIST FILE will delete it at DESTINATION
@@ -251,7 +1825,24 @@ Transfer/update user accounts specified in USER LIST FILE to the DESTINATION com
   -s, --simulate              simulate running the program, but perform no actions
   -q, --quiet                 run program without output to console
   -b, --backup-dir [PATH]     set the remote directory to store backups of /etc/shadow and /etc/passwd, by default it is /mnt/pymigrate/backups
+      --keep-backups [COUNT]  keep the COUNT most recent backups at the destination (0 keeps all), by default it is 100
   -p, --port [PORT NUMBER]    specify a different SSH port at the destination
+      --batch                 stream all actions to DESTINATION over a single SSH session
+      --create-groups         create groups that migrating users need at DESTINATION, copied from the local /etc/group
+      --bulk                  apply all changes by rewriting passwd and shadow once at DESTINATION (needs perl there)
+  -j, --jobs [COUNT]          apply up to COUNT user changes at once (with --batch, use COUNT SSH sessions)
+      --verify                look up the users changed at DESTINATION afterwards and report any that didn't converge
+      --max-runtime [SECONDS] leave migrations not started within SECONDS of the run's start for the next run
+      --cache-dir [PATH]      set the local directory caching destination snapshots, by default it is /var/cache/pymigrate
+      --no-cache              always fetch the full destination snapshot and don't keep a cache
+      --remote-diff           compare accounts by digest and only fetch the destination entries that differ
+      --stats FILE            append per-phase timings and counters of each run to FILE as JSON ("-" for stdout)
+      --plan [FILE]           write every user's category at each DESTINATION to FILE as JSON lines instead of making changes
+      --apply [PLAN FILE]     apply the changes in a plan written by --plan, if the local accounts still match it
+      --resume                finish an interrupted run's remaining changes from its journal if DESTINATION hasn't changed since
+      --user-database         read USER LIST FILE as the VCN user database and list its users with PPP access
+      --shards [SPEC]         sync the UID range as shards in parallel processes: a count, or ranges like 1000-9999,10000-60000
+  -w, --watch                 keep running and push changes to /etc/passwd, /etc/shadow and USER LIST FILE as they happen
 
 Example:
     ./migrate.py root@192.168.1.257 list_of_users.txt
@@ -261,13 +1852,20 @@ Example:
 # Print a message to console if the --quiet option is turned off.
 def printLoud(msg):
     if not options['quiet']:
-        print msg
+        printMessage(msg)
+
+
+# Print a message to console, prefixed with the destination it concerns when several are being synchronized.
+def printMessage(msg):
+    prefix = getattr(threadState, 'prefix', '')
+    with outputLock:
+        print '\n'.join([prefix + line for line in msg.split('\n')])
 
 
 # Print a message to console if the --verbose option is turn on (--quiet overrides this).
 def printVerbose(msg):
     if options['verbose'] and not options['quiet']:
-        print msg
+        printMessage(msg)
 
 
 # Process the command-line arguments and return a count of how many were consumed.
@@ -281,14 +1879,7 @@ def processCommandLineOptions():
             optionArguments.append(item)
 
     # Set default option values.
-    options = {
-        'unlistedGetDeleted': False,
-        'verbose': False,
-        'simulate': False,
-        'quiet': False,
-        'backupDir': DEFAULT_REMOTE_BACKUP_DIR,
-        'port': DEFAULT_SSH_PORT
-    }
+    options = defaultOptions()
 
     # Process command-line options.
     argsConsumed = 0
@@ -315,32 +1906,762 @@ def processCommandLineOptions():
         elif sys.argv[i] == '-p' or sys.argv[i] == '--port':
             argsConsumed += 2
             options['port'] = sys.argv[i + 1]
+        elif sys.argv[i] == '--batch':
+            argsConsumed += 1
+            options['batch'] = True
+        elif sys.argv[i] == '-j' or sys.argv[i] == '--jobs':
+            argsConsumed += 2
+            options['jobs'] = max(1, numericOption(sys.argv[i], sys.argv[i + 1]))
+        elif sys.argv[i] == '--cache-dir':
+            argsConsumed += 2
+            options['cacheDir'] = sys.argv[i + 1]
+        elif sys.argv[i] == '--no-cache':
+            argsConsumed += 1
+            options['cache'] = False
+        elif sys.argv[i] == '-w' or sys.argv[i] == '--watch':
+            argsConsumed += 1
+            options['watch'] = True
+        elif sys.argv[i] == '--bulk':
+            argsConsumed += 1
+            options['bulk'] = True
+        elif sys.argv[i] == '--resume':
+            argsConsumed += 1
+            options['resume'] = True
+        elif sys.argv[i] == '--user-database':
+            argsConsumed += 1
+            options['userDatabase'] = True
+        elif sys.argv[i] == '--shards':
+            argsConsumed += 2
+            options['shards'] = sys.argv[i + 1]
+        elif sys.argv[i] == '--create-groups':
+            argsConsumed += 1
+            options['createGroups'] = True
+        elif sys.argv[i] == '--max-runtime':
+            argsConsumed += 2
+            options['maxRuntime'] = max(0, numericOption(sys.argv[i], sys.argv[i + 1], float))
+        elif sys.argv[i] == '--verify':
+            argsConsumed += 1
+            options['verify'] = True
+        elif sys.argv[i] == '--keep-backups':
+            argsConsumed += 2
+            options['backupsKept'] = max(0, numericOption(sys.argv[i], sys.argv[i + 1]))
+        elif sys.argv[i] == '--plan':
+            argsConsumed += 2
+            options['plan'] = sys.argv[i + 1]
+        elif sys.argv[i] == '--apply':
+            argsConsumed += 2
+            options['applyPlan'] = sys.argv[i + 1]
+        elif sys.argv[i] == '--remote-diff':
+            argsConsumed += 1
+            options['remoteDiff'] = True
+        elif sys.argv[i] == '--stats':
+            argsConsumed += 2
+            options['stats'] = sys.argv[i + 1]
 
     return argsConsumed
 
 
+# Generate the lines of a gzip stream as it is read, without holding the whole stream in memory.
+def readCompressedLines(stream):
+    decompressor, partialLine = zlib.decompressobj(16 + zlib.MAX_WBITS), ''
+    for chunk in iter(lambda: stream.read(65536), ''):
+        runStats.count('remoteBytes', len(chunk))
+        lines = (partialLine + decompressor.decompress(chunk)).split('\n')
+        partialLine = lines.pop()
+        for line in lines:
+            yield line
+    partialLine += decompressor.flush()
+    if partialLine:
+        yield partialLine
+
+
+# Read a destination's journal and return its plan records, a dictionary of the exit status of each finished
+# action keyed by its index, and the fingerprint of passwd and shadow after the last finished action (None if
+# that isn't known). Returns None if there is no readable journal. A line cut short by a killed run is skipped.
+def readJournal(target):
+    try:
+        with open(journalPath(target), 'r') as journal:
+            lines = journal.read().splitlines()
+    except IOError:
+        return None
+
+    records, statuses, fingerprint = [], {}, None
+    for lineNumber, line in enumerate(lines):
+        try:
+            record = dict([(str(key), value.encode('utf-8') if isinstance(value, unicode) else value)
+                           for key, value in json.loads(line).iteritems()])
+        except (ValueError, AttributeError):
+            continue
+        if lineNumber == 0:
+            if record.get('destination') != target:
+                return None
+            fingerprint = record.get('fingerprint')
+        elif 'action' in record:
+            records.append(record)
+        elif 'index' in record:
+            statuses[record['index']], fingerprint = record['status'], record.get('fingerprint')
+    return records, statuses, fingerprint
+
+
+# Read a plan saved by --plan one record at a time.
+def readPlan(planFilename):
+    try:
+        with open(planFilename, 'r') as planLines:
+            for lineNumber, line in enumerate(planLines, 1):
+                try:
+                    record = dict([(str(key), value.encode('utf-8') if isinstance(value, unicode) else value)
+                                   for key, value in json.loads(line).iteritems()])
+                    record['destination'], record['user'], record['action']
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    raise MigrationError("Line " + str(lineNumber) + " of plan " + planFilename +
+                                         " isn't a plan record.", EXIT_CODE_FAILURE_TO_OPEN_LOCAL_FILE)
+                yield record
+    except IOError as e:
+        raise MigrationError("Unable to open plan " + planFilename + ". " + str(e),
+                             EXIT_CODE_FAILURE_TO_OPEN_LOCAL_FILE)
+
+
+# Read the usernames of the users with PPP access (types o, p and v) from the VCN user database, taking its lock
+# the way fetch-usernames.pl does. The execution lock is already held, so the two locks are taken together like
+# that script takes them. With blocking set, wait for the database's lock instead of quitting. The database is a
+# dbm hash of tab separated records keyed by username, and any dbm format Python can detect is accepted.
+def readUserDatabase(databasePath, blocking=False):
+    printVerbose("Reading users with PPP access from " + databasePath + "...")
+    try:
+        databaseLockFile = open(DATABASE_LOCK_FILE, 'w')
+        if blocking:
+            fcntl.flock(databaseLockFile, fcntl.LOCK_EX)
+        else:
+            fcntl.flock(databaseLockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        if e[0] == 11:
+            raise MigrationError("Unable to lock user database for exclusive access.", EXIT_CODE_DATABASE_LOCKED)
+        raise MigrationError("Locking " + DATABASE_LOCK_FILE + " triggered:\n" + str(e),
+                             EXIT_CODE_FAILURE_TO_OPEN_LOCAL_FILE)
+
+    try:
+        databaseLockFile.write(str(os.getpid()))
+        databaseLockFile.flush()
+        try:
+            database = anydbm.open(databasePath, 'r')
+        except Exception as e:  # Each dbm module, and the format detection itself, raise errors of their own.
+            raise MigrationError("Cannot open user database: " + databasePath + ". " + str(e),
+                                 EXIT_CODE_FAILURE_TO_OPEN_LOCAL_FILE)
+
+        # Filter the records in the same pass that reads them.
+        listedUsers = set()
+        for username in database.keys():
+            fields = database[username].split('\t')
+            if len(fields) > DATABASE_USER_TYPE_FIELD and fields[DATABASE_USER_TYPE_FIELD] in DATABASE_LISTED_TYPES:
+                listedUsers.add(username)
+        database.close()
+    finally:
+        fcntl.flock(databaseLockFile, fcntl.LOCK_UN)
+        databaseLockFile.close()
+    return listedUsers
+
+
+# Remember the outcome of the backup made while reading a destination's groups (see backupRemoteAndReadGroups()),
+# from the line it was reported on, so that performActions() doesn't make another one.
+def recordBackup(target, line):
+    fields = line.split()
+    if len(fields) == 3 and fields[0] == BACKUP_MARKER:
+        remoteBackups[target] = (int(fields[1]), fields[2])
+    else:
+        remoteBackups.pop(target, None)
+
+
+# Remember the GIDs that a destination's snapshot fetch reported on a GROUPS_MARKER line, so that migrations into
+# missing groups can be caught before they are attempted. They are forgotten if the line is missing.
+def recordGroups(target, line):
+    fields = line.split()
+    if fields and fields[0] == GROUPS_MARKER:
+        destinationGroups[target] = set(fields[1:])
+    else:
+        destinationGroups.pop(target, None)
+
+
+# Construct the destination shell command that runs one of the embedded perl helpers with the given (already
+# quoted) arguments. If perl isn't installed there the command exits with PERL_MISSING_STATUS, so that callers can
+# report that (see perlMissingError()) rather than a failed read.
+def remotePerlCommand(helper, arguments):
+    return "if command -v perl >/dev/null; then perl -e " + pipes.quote(helper) + " " + arguments + "; " + \
+           "else (exit " + str(PERL_MISSING_STATUS) + "); fi"
+
+
+# Construct the destination shell commands that back up passwd and shadow (see backupCommand()) and report the
+# outcome on a BACKUP_MARKER line if backup is set, and that list the GIDs of /etc/group on a GROUPS_MARKER line if
+# groups is set (see recordBackup() and recordGroups()).
+def remoteReportScript(backup, groups):
+    script = ""
+    if backup:
+        script += "{ " + backupCommand() + "; } </dev/null >/dev/null; " + \
+                  "echo \"" + BACKUP_MARKER + " $? ${backup:--}\"; "
+    if groups:
+        script += "echo \"" + GROUPS_MARKER + " $(cut -d: -f3 /etc/group | tr '\\n' ' ')\"; "
+    return script
+
+
+# Wrap a remote command that reads /etc/passwd and /etc/shadow into a script that first prints a fingerprint of
+# both files and last the command's exit status, all gzipped. If the fingerprint equals cachedFingerprint then the
+# command is skipped and SNAPSHOT_UNCHANGED is printed instead. With groups set, a GROUPS_MARKER line listing the
+# GIDs of /etc/group follows the fingerprint, whether the snapshot is unchanged or not. The files aren't backed up
+# here, since most runs have nothing to change; performActions() backs them up when there is.
+def remoteSnapshotScript(command, cachedFingerprint=None, groups=False):
+    return "{ fingerprint=$(" + FINGERPRINT_COMMAND + "); echo \"$fingerprint\"; " + \
+           remoteReportScript(False, groups) + \
+           "if [ -n \"$fingerprint\" ] && [ \"$fingerprint\" = " + pipes.quote(cachedFingerprint or '') + " ]; " + \
+           "then echo " + SNAPSHOT_UNCHANGED + "; echo \"" + STATUS_MARKER + " 0\"; else " + \
+           command + "; echo \"" + STATUS_MARKER + " $?\"; fi; } | gzip -c"
+
+
+# Emit the statistics of the run for the --stats option: one JSON object per run, appended to the stats file (or
+# printed if it is "-") so that runs can be graphed over time, and one condensed line through syslog.
+def reportStats():
+    global runStats
+
+    if options['stats'] is None:
+        return
+    report = json.dumps(runStats.report(), sort_keys=True)
+    if options['stats'] == '-':
+        printMessage(report)
+    else:
+        try:
+            with open(options['stats'], 'a') as statsFile:
+                statsFile.write(report + '\n')
+        except IOError as e:
+            printLoud("WARNING: Unable to write statistics to " + options['stats'] + ". " + str(e))
+    logMessage(syslog.LOG_INFO, runStats.summary())
+    runStats = RunStats()
+
+
+# Carry on with the actions of a destination's interrupted run for --resume, skipping those its journal shows
+# finished successfully. Nothing is fetched but the fingerprint of passwd and shadow, which must match the one
+# recorded after the last finished action, and the local accounts of the remaining actions must be the same
+# as when the run started. Returns False if there is nothing to resume or either check fails, leaving the caller to
+# synchronize the destination from scratch.
+def resumeDestination(destAddress, srcAccountDict):
+    journal = readJournal(destAddress)
+    if journal is None:
+        printVerbose("No interrupted run to resume.")
+        return False
+    records, statuses, lastFingerprint = journal
+
+    remainingRecords = [record for index, record in enumerate(records) if statuses.get(index) != 0]
+    for record in remainingRecords:
+        srcAccount = srcAccountDict.get(record['user'])
+        if (srcAccount and accountDigest(srcAccount)) != record['sourceDigest']:
+            printLoud("Local accounts changed since the interrupted run, starting over.")
+            discardJournal(destAddress)
+            return False
+    fingerprint = fetchRemoteFingerprint(destAddress)
+    if fingerprint is None or fingerprint != lastFingerprint:
+        printLoud("Destination changed since the interrupted run's last recorded change, starting over.")
+        discardJournal(destAddress)
+        return False
+
+    printLoud("Resuming interrupted run: " + str(len(records) - len(remainingRecords)) + " of " +
+              str(len(records)) + " user changes were already made.")
+    if not remainingRecords:
+        discardJournal(destAddress)
+        return True
+    remoteFingerprints[destAddress] = fingerprint
+    performPlannedActions(destAddress, actionsFromRecords(remainingRecords, srcAccountDict), srcAccountDict)
+    return True
+
+
+# Call a function on each of several destinations at the same time, one thread each, and return a list of
+# (destination, exit code, message) results in the order the destinations were given. The function raises a
+# MigrationError if it can't finish its destination.
+def runForDestinations(destAddresses, function):
+    results = dict([(destAddress, (EXIT_CODE_DESTINATION_FAILED, "Synchronization stopped unexpectedly."))
+                    for destAddress in destAddresses])
+
+    def runOne(destAddress):
+        threadState.destination = destAddress
+        if len(destAddresses) > 1 or shard is not None:
+            threadState.prefix = shardLabel(destAddress) + ": "
+        try:
+            function(destAddress)
+            results[destAddress] = (EXIT_CODE_SUCCESS, "Synchronized.")
+        except MigrationError as e:
+            results[destAddress] = (e.exitCode, str(e))
+        finally:
+            # A single destination runs in the calling thread, which mustn't keep the destination's state.
+            del threadState.destination
+            threadState.__dict__.pop('prefix', None)
+
+    runInParallel(runOne, destAddresses, len(destAddresses))
+    return [(destAddress,) + results[destAddress] for destAddress in destAddresses]
+
+
+# Call a function on every item of a list using a bounded pool of worker threads.
+def runInParallel(function, items, workerCount):
+    if workerCount <= 1:
+        for item in items:
+            function(item)
+        return
+
+    itemQueue = Queue.Queue()
+    for item in items:
+        itemQueue.put(item)
+
+    def work():
+        while True:
+            try:
+                item = itemQueue.get_nowait()
+            except Queue.Empty:
+                return
+            function(item)
+
+    workers = [threading.Thread(target=work) for worker in range(min(workerCount, len(items)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+# Keep the snapshot of a destination's user accounts in memory and write it to its cache file along with the
+# fingerprint it is valid for. The file holds password hashes so it is only readable by root, and it is replaced atomically so a
+# crash can't leave a half written snapshot behind.
+def saveDestinationCache(target, fingerprint, accountDict):
+    if not fingerprint:
+        return
+
+    destinationSnapshots[target] = (fingerprint, accountDict)
+
+    cachePath = destinationCachePath(target)
+    try:
+        if not os.path.isdir(options['cacheDir']):
+            os.makedirs(options['cacheDir'], 0700)
+        with os.fdopen(os.open(cachePath + '.new', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'w') as cacheFile:
+            cacheFile.write(fingerprint + '\n')
+            for account in accountDict.itervalues():
+                cacheFile.write(':'.join([account.username, 'x', account.uid, account.gid, account.gecos]) + '\n')
+            cacheFile.write(SNAPSHOT_SEPARATOR + '\n')
+            for account in accountDict.itervalues():
+                cacheFile.write(account.username + ':' + account.password + '\n')
+        os.rename(cachePath + '.new', cachePath)
+    except (IOError, OSError) as e:
+        printLoud("WARNING: Unable to write destination cache " + cachePath + ". " + str(e))
+
+
+# Keep the set of listed users for the next run to compare its list with. It is only written when it changes.
+def saveListedUsers(listedUsers):
+    if not options['cache'] or options['simulate']:
+        return
+
+    listPath = os.path.join(options['cacheDir'], LISTED_USERS_FILE)
+    try:
+        if not os.path.isdir(options['cacheDir']):
+            os.makedirs(options['cacheDir'], 0700)
+        with open(listPath + '.new', 'w') as listFile:
+            listFile.write(''.join([username + '\n' for username in sorted(listedUsers)]))
+        os.rename(listPath + '.new', listPath)
+    except (IOError, OSError) as e:
+        printLoud("WARNING: Unable to write " + listPath + ". " + str(e))
+
+
+# Keep a digest of each local account (see accountDigest()) for the next run to find the users that changed since
+# this one. The index is labelled with the inode, size and mtime of the passwd and shadow files it was made from,
+# so a run whose files still match the label knows they haven't changed without reading them. It holds digests of
+# password hashes so it is only readable by root, and it is replaced atomically.
+def saveLocalIndex(label, digests):
+    indexPath = os.path.join(options['cacheDir'], LOCAL_INDEX_FILE)
+    try:
+        if not os.path.isdir(options['cacheDir']):
+            os.makedirs(options['cacheDir'], 0700)
+        with os.fdopen(os.open(indexPath + '.new', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'w') as indexFile:
+            indexFile.write(label + '\n')
+            indexFile.writelines([userName + ' ' + digest + '\n' for userName, digest in digests.iteritems()])
+        os.rename(indexPath + '.new', indexPath)
+    except (IOError, OSError) as e:
+        printLoud("WARNING: Unable to write local index " + indexPath + ". " + str(e))
+
+
+# Record that a destination was brought fully in sync from the local accounts and user list labelled by
+# sourceState, along with the fingerprint of its cached snapshot at the time, or forget it if state is None.
+def saveSyncState(target, state):
+    statePath = destinationCachePath(target) + '.synced'
+    try:
+        if state is None:
+            if os.path.exists(statePath):
+                os.remove(statePath)
+            return
+        with open(statePath + '.new', 'w') as stateFile:
+            json.dump(state, stateFile, sort_keys=True)
+        os.rename(statePath + '.new', statePath)
+    except (IOError, OSError) as e:
+        printLoud("WARNING: Unable to write " + statePath + ". " + str(e))
+
+
+# Get the local accounts and the users each destination needs to look at, using the local index (see
+# saveLocalIndex()) when it can be used. If passwd and shadow still match the index then they aren't read at all
+# and None is returned in place of the accounts (see loadLocalUsers()). Otherwise they are parsed and compared to
+# the index by digest to find the users that changed. A destination that the last run left fully in sync (see
+# saveSyncState()), and that hasn't changed since, only needs to look at those users and the ones added to or
+# removed from the list. Other destinations get no candidates and look at every user.
+def scanLocalChanges(destAddresses, listedUsers, lastListedUsers, lastListLabel):
+    global sourceState
+
+    if not useLocalIndex():
+        printVerbose("Loading local users...")
+        return getLocalUsers(), {}
+
+    label = json.dumps(statFiles([LOCAL_PASSWD_FILE, LOCAL_SHADOW_FILE]))
+    lastLabel = loadLocalIndex(readDigests=False)[0]
+    if label == lastLabel and not options['remoteDiff'] and not options['resume']:
+        printVerbose("Local accounts are unchanged since the last run.")
+        srcAccountDict, changedUsers = None, set()
+    else:
+        printVerbose("Loading local users...")
+        srcAccountDict, changedUsers = getLocalUsers(), set()
+        if label != lastLabel:
+            digests = dict([(userName, accountDigest(account)) for userName, account in srcAccountDict.iteritems()])
+            lastDigests = loadLocalIndex()[1]
+            if lastDigests is None:
+                changedUsers = None
+            else:
+                changedUsers = set([userName for userName, digest in digests.iteritems()
+                                    if lastDigests.get(userName) != digest])
+                changedUsers.update([userName for userName in lastDigests if userName not in digests])
+            saveLocalIndex(label, digests)
+    sourceState = {'source': label, 'list': listedUsersLabel(), 'unlistedGetDeleted': options['unlistedGetDeleted']}
+
+    candidatesByDestination = {}
+    if changedUsers is not None and lastLabel is not None and lastListedUsers is not None:
+        lastState = {'source': lastLabel, 'list': lastListLabel, 'unlistedGetDeleted': options['unlistedGetDeleted']}
+        candidateUsers = changedUsers | (listedUsers ^ lastListedUsers)
+        for destAddress in destAddresses:
+            fingerprint = loadDestinationCacheFingerprint(destAddress)
+            if fingerprint is not None and loadSyncState(destAddress) == {'state': lastState,
+                                                                          'fingerprint': fingerprint}:
+                candidatesByDestination[destAddress] = candidateUsers
+        if candidatesByDestination:
+            printVerbose("Local changes since the last run affect " + str(len(candidateUsers)) + " users.")
+    return srcAccountDict, candidatesByDestination
+
+
+# Split a list of Actions into sequenceCount sequences of action indexes that can be worked through at the same
+# time. Lanes (see groupActionsIntoLanes) are dealt out whole, largest first, to whichever sequence is shortest,
+# and each sequence then merges its lanes by priority so that deletions and updates come before migrations while
+# every lane keeps its own order.
+def scheduleActions(actions, sequenceCount):
+    lanes = groupActionsIntoLanes(actions)
+    laneGroups = [[] for sequence in range(max(1, min(sequenceCount, len(lanes))))]
+    sizes = [0] * len(laneGroups)
+    for lane in sorted(lanes, key=len, reverse=True):
+        shortest = sizes.index(min(sizes))
+        laneGroups[shortest].append([(ACTION_PRIORITIES[actions[index].kind], index) for index in lane])
+        sizes[shortest] += len(lane)
+    return [[index for priority, index in heapq.merge(*laneGroup)] for laneGroup in laneGroups]
+
+
+# Name a destination along with the shard of it that this worker synchronizes, if any.
+def shardLabel(destAddress):
+    if shard is None:
+        return destAddress
+    return destAddress + " [UIDs %d-%d]" % shard
+
+
+# Get the suffix that keeps the file names of a shard's cache and journal apart from other shards'.
+def shardSuffix():
+    if shard is None:
+        return ''
+    return '_%d-%d' % shard
+
+
+# Get the inclusive range of UIDs synchronized by this worker: its shard or, if unsharded, every managed UID.
+def shardUidRange():
+    if shard is None:
+        return LOWEST_USER_ID, HIGHEST_USER_ID
+    return shard
+
+
+# Construct the argument list that starts an ssh session to a remote machine, reusing the master
+# connection to that machine if one has been opened.
+def sshArguments(target):
+    arguments = ['ssh', '-p', str(options['port'])]
+    if target in sshControlPaths:
+        arguments += ['-o', 'ControlMaster=auto', '-o', 'ControlPath=' + sshControlPaths[target],
+                      '-o', 'ControlPersist=' + str(SSH_CONTROL_PERSIST)]
+    return arguments + [target]
+
+
+# Construct a shell command line that runs a command at a remote machine over ssh.
+def sshCommand(target, remoteCommand):
+    arguments = sshArguments(target)[:-1] + ['-n', target, remoteCommand]
+    return ' '.join([pipes.quote(argument) for argument in arguments])
+
+
+# Get the identity, size and modification time of each of a list of files (None for missing files).
+def statFiles(paths):
+    stats = []
+    for path in paths:
+        try:
+            fileStat = os.stat(path)
+            stats.append((fileStat.st_ino, fileStat.st_size, fileStat.st_mtime))
+        except OSError:
+            stats.append(None)
+    return stats
+
+
+# Synchronize the listed users' accounts at one destination: connect, load the destination's accounts, categorize
+# users and apply the resulting actions, or only show them in --simulate mode. Raises a MigrationError if the
+# destination can't be synchronized. When candidateUsers is given and the destination is unchanged since it was
+# last synchronized, only those users are looked at. If srcAccountDict is None then the local accounts are only
+# parsed if they are needed (see scanLocalChanges()).
+def syncDestination(destAddress, listedUsers, srcAccountDict, missingUsers, candidateUsers=None):
+    # Test remote connection and keep it open for the rest of the run.
+    if destAddress not in sshControlPaths:
+        with runStats.phase('connect'):
+            status, output = openSshMaster(destAddress)
+        if status != 0:
+            raise MigrationError(output, EXIT_CODE_UNABLE_TO_CONNECT)
+
+    # Finish an interrupted run instead, if there is one that can be resumed.
+    if options['resume'] and not options['simulate'] and options['plan'] is None:
+        if resumeDestination(destAddress, srcAccountDict):
+            return
+
+    printVerbose("Loading remote users...")
+    with runStats.phase('fetch'):
+        destAccountDict, destUnchanged = getRemoteUsers(destAddress, srcAccountDict, candidateUsers != set())
+    if not destUnchanged:
+        candidateUsers = None
+
+    # An unchanged destination with no candidate users needs neither side's accounts. Any other needs the local ones.
+    if candidateUsers == set():
+        srcAccountDict = {} if srcAccountDict is None else srcAccountDict
+        destAccountDict = {} if destAccountDict is None else destAccountDict
+    elif srcAccountDict is None:
+        srcAccountDict = loadLocalUsers()
+
+    # A shard is responsible for the destination accounts with UIDs in it, whatever their local UIDs are now, and
+    # for migrating the listed users whose local UIDs are in it.
+    if shard is not None:
+        candidateUsers = set(destAccountDict)
+        for userName in listedUsers:
+            if userName in srcAccountDict and shard[0] <= int(srcAccountDict[userName].uid) <= shard[1]:
+                candidateUsers.add(userName)
+
+    """
+        ###################################################################
+        ###########   CATEGORIZE USERS   ##################################
+        ###################################################################
+    """
+    with runStats.phase('categorize'):
+        migratingUsers, doomedUsers, updatingUsers = categorizeUsers(listedUsers, srcAccountDict, destAccountDict,
+                                                                     candidateUsers)
+
+    # Users that seem new to a shard may already be at the destination under a UID in another shard, whose worker
+    # moves them into this one, so look those users up by name before migrating them.
+    if shard is not None and migratingUsers:
+        with runStats.phase('fetch'):
+            elsewhereAccountDict = fetchRemoteRows(destAddress, migratingUsers)[1]
+        if elsewhereAccountDict:
+            printVerbose(str(len(elsewhereAccountDict)) + " users are at the destination under UIDs of other shards.")
+            migratingUsers = [userName for userName in migratingUsers if userName not in elsewhereAccountDict]
+
+    # Don't plan or attempt migrations into groups that don't exist at the destination. Missing groups are only
+    # created when changes are being made.
+    migratingUsers, skippedUsers = checkDestinationGroups(destAddress, migratingUsers, srcAccountDict,
+                                                          not options['simulate'] and options['plan'] is None)
+
+    # Optionally only write out the plan, or show it in simulation mode.
+    if options['plan'] is not None:
+        writePlan(destAddress, planRecords(listedUsers, srcAccountDict, destAccountDict, missingUsers,
+                                           migratingUsers, doomedUsers, updatingUsers, skippedUsers),
+                  srcAccountDict, destAccountDict)
+        return
+    if options['simulate']:
+        printLoud("Determining users that aren't being changed (ignored users).")
+        categories = {'migrate': [], 'delete': [], 'update': [], 'missing': [], 'missingGroup': [], 'ignore': []}
+        for category, userName in planRecords(listedUsers, srcAccountDict, destAccountDict, missingUsers,
+                                               migratingUsers, doomedUsers, updatingUsers, skippedUsers):
+            categories[category].append(userName)
+
+        # Show simulation results.
+        printMessage("Simulated User Categorization\n" +
+                     "-----------------------------\n" +
+                     "  Migrate:   " + usernameListToLimitedString(categories['migrate']) + "\n" +
+                     "  Delete:    " + usernameListToLimitedString(categories['delete']) + "\n" +
+                     "  Update:    " + usernameListToLimitedString(categories['update']) + "\n" +
+                     "  Missing:   " + usernameListToLimitedString(categories['missing']) + "\n" +
+                     "  No group:  " + usernameListToLimitedString(categories['missingGroup']) + "\n" +
+                     "  Ignore:    " + usernameListToLimitedString(categories['ignore']))
+        return
+
+    """
+        ###################################################################
+        #########   PERFORM ACTIONS ON USERS     ##########################
+        ###################################################################
+    """
+    if skippedUsers:
+        logSkippedMigrations(skippedUsers)
+
+    # Accounts moving onto UIDs of other shards wait for those shards to free them. If that would deadlock then the
+    # moves are left for the next run.
+    heldUsers = []
+    if shard is not None:
+        movingUsers = [userName for userName in updatingUsers
+                       if not shard[0] <= int(srcAccountDict[userName].uid) <= shard[1]]
+        if movingUsers and not lockShardUids([int(srcAccountDict[userName].uid) for userName in movingUsers]):
+            logMessage(syslog.LOG_WARNING, "Deferred updates: " + usernameListToLimitedString(movingUsers) +
+                       ". Their new UIDs are locked by a shard that is waiting for this one.")
+            heldUsers = movingUsers
+            updatingUsers = [userName for userName in updatingUsers if userName not in heldUsers]
+
+    # Check if there are any actions to be performed.
+    inSync = not skippedUsers and not heldUsers
+    if not (migratingUsers or doomedUsers or updatingUsers):
+        printLoud("No user changes need to be made.")
+        discardJournal(destAddress)
+    else:
+        performActions(destAddress, buildActions(migratingUsers, doomedUsers, updatingUsers, srcAccountDict,
+                                                 destAccountDict), srcAccountDict, destAccountDict)
+        succeeded, failed, deferred = destinationOutcomes[destAddress]
+        inSync = inSync and not sum(failed.values(), []) and not sum(deferred.values(), [])
+    if skippedUsers:
+        destinationOutcomes.setdefault(destAddress, ({}, {}, {}))[1].setdefault('migrate', []).extend(skippedUsers)
+    if heldUsers:
+        destinationOutcomes.setdefault(destAddress, ({}, {}, {}))[2].setdefault('update', []).extend(heldUsers)
+
+    # Remember whether the destination is fully in sync, so that the next run only has to look at what changes.
+    if sourceState is not None and shard is None:
+        fingerprint = loadDestinationCacheFingerprint(destAddress)
+        inSync = inSync and fingerprint is not None
+        saveSyncState(destAddress, {'state': sourceState, 'fingerprint': fingerprint} if inSync else None)
+
+
+# Synchronize several destinations at the same time, one thread each, and return a list of (destination, exit code,
+# message) results in the order the destinations were given. An optional dictionary gives the candidate users
+# for each destination (see syncDestination).
+def syncDestinations(destAddresses, listedUsers, srcAccountDict, missingUsers, candidatesByDestination={}):
+    def syncOne(destAddress):
+        syncDestination(destAddress, listedUsers, srcAccountDict, missingUsers,
+                        candidatesByDestination.get(destAddress))
+    return runForDestinations(destAddresses, syncOne)
+
+
+# Synchronize one shard of the managed UID range at several destinations. This is the body of a worker process
+# started by syncShards(), which puts the worker's (destination, exit code, message) results on resultQueue.
+def syncShard(shardRange, destAddresses, listedUsers, srcAccountDict, missingUsers, resultQueue, lockEvents):
+    global shard, runStats, shardLockEvents
+
+    shard, runStats, shardLockEvents = shardRange, RunStats(), lockEvents
+    results = [(destAddress, EXIT_CODE_INSTANCE_ALREADY_RUNNING, "UIDs %d-%d are being synchronized by another run."
+                % shard) for destAddress in destAddresses]
+    try:
+        locked = lockShard()
+        dict(lockEvents)[shard].set()
+        if locked:
+            results = syncDestinations(destAddresses, listedUsers, srcAccountDict, missingUsers)
+        reportStats()
+    finally:
+        closeSshMasters()
+        resultQueue.put([(shardLabel(destAddress), exitCode, msg) for destAddress, exitCode, msg in results])
+
+
+# Synchronize each shard of the managed UID range (see parseShards()) in a worker process of its own, and return
+# the (destination, exit code, message) results of every shard at every destination. The workers are forked, so
+# they share the local accounts and list that were read once here. Each worker signals an event once it has tried
+# to lock its shard, which workers moving accounts into that shard wait for (see lockShardUids()).
+def syncShards(shards, destAddresses, listedUsers, srcAccountDict, missingUsers):
+    resultQueue = multiprocessing.Queue()
+    lockEvents = [(shardRange, multiprocessing.Event()) for shardRange in shards]
+    workers = [multiprocessing.Process(target=syncShard, args=(shardRange, destAddresses, listedUsers,
+                                                               srcAccountDict, missingUsers, resultQueue, lockEvents))
+               for shardRange in shards]
+    for worker in workers:
+        worker.start()
+
+    # Collect the results before waiting for the workers, which can't finish until their results are taken.
+    results = []
+    for worker in workers:
+        results += resultQueue.get()
+    for worker in workers:
+        worker.join()
+    return sorted(results)
+
+
 # Attempt to open a local text file and convert to a list of lines.
 def textFileIntoLines(filePath):
     try:
         with open(filePath, 'r') as textFile:
             textLines = textFile.read().splitlines()
     except IOError as e:
-        logExit(syslog.LOG_ERR, "Unable to open local file" + filePath +
-                ". " + str(e), EXIT_CODE_FAILURE_TO_OPEN_LOCAL_FILE)
+        raise MigrationError("Unable to open local file " + filePath + ". " + str(e),
+                             EXIT_CODE_FAILURE_TO_OPEN_LOCAL_FILE)
 
     return textLines
 
 
-# Propagate password, UID and gecos fields from a local account to the remote of same username.
-def updateRemoteUser(target, localUserAcct):
-    password = localUserAcct.password
-    uid = localUserAcct.uid
-    gecos = localUserAcct.gecos
-    username = localUserAcct.username
-    # Construct and execute command to remotely update user password, UID and gecos field.
-    cmd = "ssh -p " + str(options['port']) + " -n " + target + " /usr/sbin/usermod -p \\''" + \
-          password + "'\\' -u " + str(uid) + " -c \\''" + gecos + "'\\' " + username
-    executeCommand(cmd)
+# Release the lock taken by lockExecution().
+def unlockExecution():
+    if lockFile is not None:
+        fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+
+# Bring the cached snapshot of a destination up to date with the actions that were just applied to it, so the
+# next run doesn't need to fetch the destination's files again. The patched snapshot is stored under the
+# fingerprint reported just after the last action (or the one it was read with, if no action ran), and only if the
+# destination still has that fingerprint: anything else changed the files too, so the patched snapshot can't be
+# trusted. If any action failed then its effect at the destination is uncertain and the cache is dropped instead,
+# forcing a full fetch next time. The cache is also dropped when destAccountDict is None, meaning the
+# destination's accounts weren't read before the actions, and when sharded, since other shards' workers may have
+# changed the destination in between.
+def updateDestinationCache(target, destAccountDict, srcAccountDict, actions, statuses):
+    fingerprint = actionFingerprints.pop(target, None)
+    if not options['cache'] or options['simulate']:
+        return
+
+    if fingerprint is None or destAccountDict is None or shard is not None or \
+       [status for status in statuses if status not in (0, ACTION_DEFERRED)] or \
+       fetchRemoteFingerprint(target) != fingerprint:
+        fingerprint = None
+    if fingerprint is None:
+        destinationSnapshots.pop(target, None)
+        try:
+            os.remove(destinationCachePath(target))
+        except OSError:
+            pass
+        return
+
+    for action, status in zip(actions, statuses):
+        if status == ACTION_DEFERRED:
+            continue
+        elif action.kind == 'migrate':
+            srcAccount = srcAccountDict[action.username]
+            destAccountDict[action.username] = Account(srcAccount.username, srcAccount.password, srcAccount.uid,
+                                                       srcAccount.gid, srcAccount.gecos)
+        elif action.kind == 'delete':
+            del destAccountDict[action.username]
+        else:
+            destAccount, srcAccount = destAccountDict[action.username], srcAccountDict[action.username]
+            destAccount.password, destAccount.uid, destAccount.gecos = \
+                srcAccount.password, srcAccount.uid, srcAccount.gecos
+    saveDestinationCache(target, fingerprint, destAccountDict)
+
+
+# Construct the destination shell command that copies the password, UID and gecos fields of a local account.
+def updateUserCommand(localUserAcct):
+    return "/usr/sbin/usermod -p " + pipes.quote(localUserAcct.password) + " -u " + str(localUserAcct.uid) + \
+           " -c " + pipes.quote(localUserAcct.gecos) + " " + localUserAcct.username
+
+
+# Check whether this run can use the local index (see scanLocalChanges()). Only runs that make changes and don't
+# work on shards keep it, and it is kept in the cache directory so --no-cache turns it off too.
+def useLocalIndex():
+    return options['cache'] and not options['simulate'] and options['plan'] is None and options['shards'] is None
+
+
+# Get the files that hold USER LIST FILE, for watching it. A dbm database may be held by the file itself or by files
+# with the extensions that the dbm modules add.
+def userListPaths(userListFilename):
+    if options['userDatabase']:
+        return [userListFilename] + [userListFilename + extension for extension in ('.db', '.dir', '.pag', '.dat')]
+    return [userListFilename]
 
 
 # Turn a list of usernames into a string but limit the possible length of the string.
@@ -362,6 +2683,219 @@ def usernameListToLimitedString(userList):
     return returnString
 
 
+# Check that the changes a list of Actions made show up at a remote machine, by looking up only the users they
+# touched (see fetchRemoteEntries()) and comparing them to the accounts they were meant to leave behind. Every
+# user that didn't converge is reported, and actions that reported success anyway get ACTION_UNCONVERGED in
+# statuses. Returns the list of users that didn't converge. Deferred actions aren't checked.
+def verifyActions(target, actions, statuses):
+    checkedActions = [(index, action) for index, action in enumerate(actions) if statuses[index] != ACTION_DEFERRED]
+    if not checkedActions:
+        return []
+    printLoud("Verifying " + str(len(checkedActions)) + " user changes.")
+    destAccountDict = fetchRemoteEntries(target, [action.username for index, action in checkedActions])
+
+    unconvergedUsers = []
+    for index, action in checkedActions:
+        destAccount, problem = destAccountDict.get(action.username), None
+        if action.kind == 'delete':
+            if destAccount is not None:
+                problem = "still exists"
+        elif destAccount is None:
+            problem = "doesn't exist"
+        else:
+            fields = [('password', action.account.password, destAccount.password),
+                      ('UID', action.account.uid, destAccount.uid),
+                      ('gecos', action.account.gecos, destAccount.gecos)]
+            if action.kind == 'migrate':
+                fields.append(('GID', action.account.gid, destAccount.gid))
+            differences = [name for name, intended, found in fields if intended != found]
+            if differences:
+                problem = "has a different " + ", ".join(differences)
+        if problem is not None:
+            printLoud("WARNING: User " + action.username + " " + problem + " at destination after " +
+                      ACTION_VERBS[action.kind].lower() + " it.")
+            unconvergedUsers.append(action.username)
+            if statuses[index] == 0:
+                statuses[index] = ACTION_UNCONVERGED
+    return unconvergedUsers
+
+
+# Wait until a watched file changes or timeout seconds pass, and return whether anything changed. A burst of
+# changes is collected until the files have been quiet for WATCH_DEBOUNCE seconds (but no longer than
+# WATCH_DEBOUNCE_LIMIT) so that a program rewriting several files causes one sync instead of many.
+def waitForFileChanges(watcher, timeout):
+    def readEvents(waitTime):
+        if watcher['fd'] is None:
+            time.sleep(min(waitTime, WATCH_POLL_INTERVAL))
+            stats = statFiles(watcher['paths'])
+            changed, watcher['stats'] = stats != watcher['stats'], stats
+            return changed
+
+        if not select.select([watcher['fd']], [], [], waitTime)[0]:
+            return False
+        buf, changed, offset = os.read(watcher['fd'], 65536), False, 0
+        while offset + 16 <= len(buf):
+            wd, mask, cookie, nameLength = struct.unpack('iIII', buf[offset:offset + 16])
+            if buf[offset + 16:offset + 16 + nameLength].rstrip('\0') in watcher['names']:
+                changed = True
+            offset += 16 + nameLength
+        return changed
+
+    # Wait for the first change.
+    deadline = time.time() + timeout
+    while not readEvents(max(0, deadline - time.time())):
+        if time.time() >= deadline:
+            return False
+
+    # Let the burst settle.
+    burstDeadline, quietDeadline = time.time() + WATCH_DEBOUNCE_LIMIT, time.time() + WATCH_DEBOUNCE
+    while time.time() < min(quietDeadline, burstDeadline):
+        if readEvents(max(0, min(quietDeadline, burstDeadline) - time.time())):
+            quietDeadline = time.time() + WATCH_DEBOUNCE
+    return True
+
+
+# Keep running after the first sync and push changes as they happen. The parsed source and the destination
+# snapshots stay in memory between syncs, and only the users whose local accounts or list membership changed are
+# pushed, unless a destination changed on its own or its last sync failed. The execution lock is released while
+# waiting so that other programs using it (such as fetch-usernames.pl) can run in between. Each sync counts as a
+# run of its own for --max-runtime.
+def watchForChanges(destAddresses, userListFilename, listedUsers, srcAccountDict, results):
+    global runStartTime
+
+    signal.signal(signal.SIGTERM, lambda signalNumber, frame: sys.exit(EXIT_CODE_SUCCESS))
+    watcher = openFileWatcher([LOCAL_PASSWD_FILE, LOCAL_SHADOW_FILE] + userListPaths(userListFilename))
+    printLoud("Watching " + ", ".join(watcher['paths']) + " for changes.")
+
+    try:
+        while True:
+            # Report failures. Destinations whose last sync failed or deferred work get a full sync next time.
+            needFullSync = set()
+            for destAddress, exitCode, msg in results:
+                if exitCode != EXIT_CODE_SUCCESS:
+                    logMessage(syslog.LOG_WARNING, "Sync of " + destAddress + " failed (exit code " + str(exitCode) +
+                               "): " + msg)
+                    needFullSync.add(destAddress)
+                if sum(destinationOutcomes.pop(destAddress, ({}, {}, {}))[2].values(), []):
+                    needFullSync.add(destAddress)
+
+            reportStats()
+            unlockExecution()
+            filesChanged = waitForFileChanges(watcher, WATCH_RESYNC_INTERVAL)
+            lockExecution(blocking=True)
+            runStats.__init__()
+            runStartTime = time.time()
+
+            # Work out which users could have changed since the last sync.
+            with runStats.phase('readList'):
+                newListedUsers = getListedUsers(userListFilename, blocking=True)
+            with runStats.phase('parseSource'):
+                newSrcAccountDict = getLocalUsers()
+            candidateUsers = diffAccountDicts(srcAccountDict, newSrcAccountDict) | (listedUsers ^ newListedUsers)
+            listedUsers, srcAccountDict = newListedUsers, newSrcAccountDict
+            if filesChanged:
+                printVerbose("Local changes affect " + str(len(candidateUsers)) + " users.")
+            else:
+                printVerbose("Checking destinations for changes made at their end.")
+
+            candidatesByDestination = {}
+            for destAddress in destAddresses:
+                if destAddress not in needFullSync:
+                    candidatesByDestination[destAddress] = candidateUsers
+
+            results = syncDestinations(destAddresses, listedUsers, srcAccountDict, [], candidatesByDestination)
+    except KeyboardInterrupt:
+        printLoud("Stopped watching.")
+
+
+# Write a destination's plan records to the --plan file as JSON lines. Changes carry the destination UID that
+# applying them needs and a digest of the local account they were planned from (null if there is none), which the
+# apply step checks before changing anything. No password hashes are written.
+def writePlan(destAddress, records, srcAccountDict, destAccountDict):
+    for category, userName in records:
+        record = {'destination': destAddress, 'user': userName, 'action': category}
+        if category in ACTION_VERBS:
+            srcAccount, destAccount = srcAccountDict.get(userName), destAccountDict.get(userName)
+            record['uid'] = srcAccount and srcAccount.uid
+            record['sourceDigest'] = srcAccount and accountDigest(srcAccount)
+            record['destinationUid'] = destAccount and destAccount.uid
+        line = json.dumps(record, sort_keys=True)
+        with outputLock:
+            planFile.write(line + '\n')
+
+
+"""
+    ###################################################################
+    ###########   LIBRARY INTERFACE   #################################
+    ###################################################################
+"""
+
+
+# Synchronizes destinations from within another Python program, without starting a new process each time:
+#
+#     import migrate
+#     synchronizer = migrate.Synchronizer(unlistedGetDeleted=True, batch=True, quiet=True)
+#     for result in synchronizer.sync(['root@192.168.1.257'], 'bunch_of_users.txt'):
+#         print result.destination, result.exitCode, result.migrated
+#
+# Settings are the keys of defaultOptions(). The local accounts are only parsed again when /etc/passwd or
+# /etc/shadow change, and destination snapshots and master ssh connections are kept between syncs, so repeated
+# syncs only pay for what changed. Errors that stop a whole sync (such as the execution lock being held) are
+# raised as MigrationErrors, while each destination's outcome is returned as a SyncResult. Sharding, watching,
+# plans and resuming are only offered on the command line. The module keeps its state in globals, so only one
+# Synchronizer syncs at a time.
+class Synchronizer(object):
+    lock = threading.Lock()
+
+    def __init__(self, **settings):
+        self.options = defaultOptions()
+        for name in settings:
+            if name not in self.options or name in ('shards', 'watch', 'plan', 'applyPlan', 'resume'):
+                raise ValueError("Unsupported setting: " + name)
+        self.options.update(settings)
+        self.srcAccountDict, self.srcStats = None, None
+        self.snapshots = {}
+        self.stats = None
+
+    # Synchronize the listed users at each destination and return a list of SyncResults in the same order. The
+    # users can be given as the path of a user list file (or of the VCN user database, with userDatabase set) or
+    # as any collection of usernames. The run's statistics are left in the stats attribute.
+    def sync(self, destAddresses, users):
+        global options, runStats, runStartTime, destinationSnapshots
+
+        with Synchronizer.lock:
+            options, runStats, destinationSnapshots = self.options, RunStats(), self.snapshots
+            runStartTime = time.time()
+            lockExecution()
+            try:
+                with runStats.phase('readList'):
+                    listedUsers = getListedUsers(users) if isinstance(users, basestring) else set(users)
+                with runStats.phase('parseSource'):
+                    srcStats = statFiles([LOCAL_PASSWD_FILE, LOCAL_SHADOW_FILE])
+                    if self.srcAccountDict is None or srcStats != self.srcStats:
+                        self.srcAccountDict, self.srcStats = getLocalUsers(), srcStats
+                missingUsers = [userName for userName in listedUsers if userName not in self.srcAccountDict]
+
+                for destAddress in destAddresses:
+                    destinationOutcomes.pop(destAddress, None)
+                results = syncDestinations(destAddresses, listedUsers, self.srcAccountDict, missingUsers)
+                self.stats = runStats.report()
+            finally:
+                unlockExecution()
+
+            syncResults = []
+            for destAddress, exitCode, msg in results:
+                succeeded, failed, deferred = destinationOutcomes.pop(destAddress, ({}, {}, {}))
+                syncResults.append(SyncResult(destAddress, exitCode, msg, succeeded.get('migrate', []),
+                                              succeeded.get('delete', []), succeeded.get('update', []),
+                                              sum(failed.values(), []), sum(deferred.values(), [])))
+            return syncResults
+
+    # Close the master ssh connections kept open between syncs.
+    def close(self):
+        closeSshMasters()
+
+
 """
     ###################################################################
     ###########   START OF MAIN   #####################################
@@ -369,184 +2903,108 @@ def usernameListToLimitedString(userList):
 """
 
 
-def main():
-    global options
+# Run the program as the command line asked. Errors that stop the whole run are raised as MigrationErrors.
+def runCommandLine():
+    global options, runStats, runStartTime, planFile, sourceState
+
+    runStats, runStartTime = RunStats(), time.time()
 
     # Count and process the command-line options.
     optionCount = processCommandLineOptions()
 
-    # Check that the user has provided the minimum number of arguments.
-    if len(sys.argv) - optionCount < 3:
+    # Check that the user has provided the minimum number of arguments (none are needed to apply a saved plan).
+    if len(sys.argv) - optionCount < (1 if options['applyPlan'] else 3):
         printHelpMessage()
         exit(EXIT_CODE_TOO_FEW_ARGUMENTS)
 
+    # Split the UID range into shards if asked to.
+    shards = None
+    if options['shards'] is not None:
+        if options['watch'] or options['plan'] is not None or options['applyPlan']:
+            printLoud("--shards can't be used with --watch, --plan or --apply.")
+            exit(EXIT_CODE_BAD_OPTIONS)
+        try:
+            shards = parseShards(options['shards'])
+        except ValueError as e:
+            printLoud("Invalid --shards " + options['shards'] + ": " + str(e) + ".")
+            exit(EXIT_CODE_BAD_OPTIONS)
+
     # Test that program is being run by a super user.
     checkForRootPrivilege()
 
-    # Prevent two instances of the program from running simultaneously.
-    lockExecution()
-
-    # Take destination and migrant list file from last two command-line arguments.
-    destAddress = sys.argv[-2]
-    userListFilename = sys.argv[-1]
-
-    # Test remote connection.
-    command = "ssh -p " + str(options['port']) + " -o BatchMode=yes " + destAddress + " exit"
-    status, output = commands.getstatusoutput(command)
-    if status != 0:
-        logExit(syslog.LOG_ERR, output, EXIT_CODE_UNABLE_TO_CONNECT)
-
-    # Load lists of usernames and construct dictionaries of account data.
-    listedUsers = textFileIntoLines(userListFilename)
-    printVerbose("Loading local users...")
-    srcUsers, srcAccountDict = getLocalUsers()
-    printVerbose("Loading remote users...")
-    destUsers, destAccountDict = getRemoteUsers(destAddress)
-
-    """
-        ###################################################################
-        ###########   CATEGORIZE USERS   ##################################
-        ###################################################################
-    """
-    # Construct a dictionary of the listed users to use as a hash table.
-    listedDict = {}
-    for userName in listedUsers:
-        listedDict[userName] = True
-
-    # Construct a list of all unique usernames.
-    allUsers = createUnionOfLists([listedUsers, srcUsers, destUsers])
+    # Prevent two instances of the program from running simultaneously. Runs on separate shards can share the lock.
+    lockExecution(shared=shards is not None)
 
-    # Categorize users.
-    printVerbose("Categorizing users.")
-    migratingUsers, doomedUsers, updatingUsers = [], [], []
-
-    for userName in allUsers:
-        # Listed users found at source but not at destination get migrated.
-        if userName in listedDict and userName in srcAccountDict and userName not in destAccountDict:
-            migratingUsers.append(userName)
+    # Apply a saved plan instead of making one.
+    if options['applyPlan']:
+        results = applyPlan(options['applyPlan'])
+        reportStats()
+        exitWithResults(results)
+        return
 
-        # Any users at destination and not at source should be marked for deletion.
-        if userName in destAccountDict:
-            if userName not in srcAccountDict:
-                doomedUsers.append(userName)
-
-            # Optionally mark for deletion users that exist at both ends but are no longer listed.
-            elif options['unlistedGetDeleted'] and userName in destAccountDict and userName not in listedDict:
-                doomedUsers.append(userName)
+    # Take destinations and migrant list file from the command-line arguments that follow the options.
+    destAddresses = sys.argv[1 + optionCount:-1]
+    userListFilename = sys.argv[-1]
 
-        # Update users that have changed their password, UID or full name (gecos).
-        if userName in srcAccountDict and userName in destAccountDict:
-            if srcAccountDict[userName].password != destAccountDict[userName].password or \
-               srcAccountDict[userName].uid != destAccountDict[userName].uid or \
-               srcAccountDict[userName].gecos != destAccountDict[userName].gecos:
-                updatingUsers.append(userName)
+    # Load the list of usernames and construct the dictionary of local account data once for all destinations,
+    # unless the local index shows it won't be needed.
+    with runStats.phase('readList'):
+        lastListedUsers, lastListLabel = loadListedUsers(), listedUsersLabel()
+        listedUsers = getListedUsers(userListFilename)
+    with runStats.phase('parseSource'):
+        srcAccountDict, candidatesByDestination = scanLocalChanges(destAddresses, listedUsers, lastListedUsers,
+                                                                   lastListLabel)
 
     # Determine missing users if that information will be shown.
     missingUsers = []
-    if options['verbose'] or options['simulate']:
+    if options['verbose'] or options['simulate'] or options['plan'] is not None:
         printLoud("Checking for listed users that are missing from source machine.")
+        localUsers = srcAccountDict
+        if localUsers is None:
+            localUsers = loadLocalIndex()[1] or loadLocalUsers()
         for userName in listedUsers:
-            if userName not in srcAccountDict:
+            if userName not in localUsers:
                 missingUsers.append(userName)
 
-    # Optionally run the program in simulation mode.
-    if options['simulate']:
-        printLoud("Determining users that aren't being changed (ignored users).")
-        # Determine which users are unchanged. Start with the set of all users.
-        allUsersDict = {}
-        for userName in allUsers:
-            allUsersDict[userName] = True
-
-        # Mark all changed users
-        for userName in migratingUsers:
-            allUsersDict[userName] = False
-        for userName in doomedUsers:
-            allUsersDict[userName] = False
-        for userName in updatingUsers:
-            allUsersDict[userName] = False
-
-        # Ignored users = all users - changed users.
-        ignoredUsers = []
-        for userName in allUsersDict.keys():
-            if allUsersDict[userName]:
-                ignoredUsers.append(userName)
-
-        # Show simulation results and quit.
-        print "Simulated User Categorization"
-        print "-----------------------------"
-        print "  Migrate:   " + usernameListToLimitedString(migratingUsers)
-        print "  Delete:    " + usernameListToLimitedString(doomedUsers)
-        print "  Update:    " + usernameListToLimitedString(updatingUsers)
-        print "  Missing:   " + usernameListToLimitedString(missingUsers)
-        print "  Ignore:    " + usernameListToLimitedString(ignoredUsers)
-        exit(EXIT_CODE_SUCCESS)
+    # Start the plan file when only making a plan.
+    if options['plan'] is not None:
+        try:
+            planFile = open(options['plan'], 'w')
+        except IOError as e:
+            raise MigrationError("Unable to create plan " + options['plan'] + ". " + str(e),
+                                 EXIT_CODE_FAILURE_TO_OPEN_LOCAL_FILE)
 
-    """
-        ###################################################################
-        #########   PERFORM ACTIONS ON USERS     ##########################
-        ###################################################################
-    """
-    # Check if there are any actions to be performed.
-    if not (migratingUsers or doomedUsers or updatingUsers):
-        printLoud("No user changes need to be made.")
+    if shards is not None:
+        results = syncShards(shards, destAddresses, listedUsers, srcAccountDict, missingUsers)
     else:
-        # Backup the user files before making changes.
-        printLoud("Backing up passwd and shadow to " + DEFAULT_REMOTE_BACKUP_DIR)
-
-        # Create the backup directory at destination machine.
-        executeCommand('ssh -p ' + str(options['port']) + ' -n ' + destAddress + ' mkdir -p ' + options['backupDir'])
-
-        # Construct a filename prefix for backup files.
-        timeStamp = datetime.datetime.now().strftime('%Y-%m-%d-%Hh-%Mm-%Ss')
-        prefix = options['backupDir'] + '/' + 'backup_' + timeStamp
-
-        # Attempt to backup files and quit the program if unable to.
-        if executeCommand('ssh -p ' + str(options['port']) + ' -n ' + destAddress + ' cp /etc/passwd ' + prefix + '_passwd'):
-            logExit(syslog.LOG_ERR, "Unable to create remote backup of /etc/passwd file.",
-                    EXIT_CODE_UNABLE_TO_BACKUP)
-        if executeCommand('ssh -p ' + str(options['port']) + ' -n ' + destAddress + ' cp /etc/shadow ' + prefix + '_shadow'):
-            logExit(syslog.LOG_ERR, "Unable to create remote backup of /etc/shadow file.",
-                    EXIT_CODE_UNABLE_TO_BACKUP)
-
-        # Migrate new users.
-        if migratingUsers:
-            printLoud("Moving new users.")
-        failedUsers = []
-        for username in migratingUsers:
-            printVerbose("    Migrating user: " + username)
-            result = addRemoteUser(destAddress, srcAccountDict[username])
-            # Keep track of any users that fail to migrate.
-            if result != 0:
-                migratingUsers.remove(username)
-                failedUsers.append(username)
-
-        # Delete users at destination if they have been marked for destruction.
-        if doomedUsers:
-            printLoud("Deleting users.")
-        for username in doomedUsers:
-            printVerbose("    Deleting user: " + username)
-            deleteRemoteUser(destAddress, username)
-
-        # Update users who have changed their password.
-        if updatingUsers:
-            printLoud("Updating user accounts.")
-        for username in updatingUsers:
-            printVerbose("    Updating user: " + username)
-            updateRemoteUser(destAddress, srcAccountDict[username])
-
-        printLoud("The following summary will be recorded in syslog:")
-        if migratingUsers:
-            logMessage(syslog.LOG_INFO, "Migrated users: " + usernameListToLimitedString(migratingUsers))
-        if doomedUsers:
-            logMessage(syslog.LOG_INFO, "Deleted users: " + usernameListToLimitedString(doomedUsers))
-        if updatingUsers:
-            logMessage(syslog.LOG_INFO, "Updated users: " + usernameListToLimitedString(updatingUsers))
-        if failedUsers:
-            logMessage(syslog.LOG_WARNING, "Failed migrations: " +
-                       usernameListToLimitedString(failedUsers) + ". Maybe their group wasn't " +
-                       "found at destination.")
-
-    if missingUsers:
+        results = syncDestinations(destAddresses, listedUsers, srcAccountDict, missingUsers, candidatesByDestination)
+
+    if planFile is not None:
+        planFile.close()
+        printLoud("Wrote plan to " + options['plan'] + ". Apply it with: " + sys.argv[0] + " --apply " +
+                  options['plan'])
+
+    if missingUsers and not options['simulate'] and options['plan'] is None:
         printLoud("Couldn't find users: " + usernameListToLimitedString(missingUsers))
 
-main()
+    # In watch mode keep going instead of exiting. Only the first sync resumes an interrupted run.
+    if options['watch']:
+        options['resume'], sourceState = False, None
+        watchForChanges(destAddresses, userListFilename, listedUsers,
+                        loadLocalUsers() if srcAccountDict is None else srcAccountDict, results)
+        exit(EXIT_CODE_SUCCESS)
+
+    reportStats()
+    exitWithResults(results)
+
+
+# Run the program from the command line, logging and exiting with the error that stopped it if there was one.
+def main():
+    try:
+        runCommandLine()
+    except MigrationError as e:
+        logExit(syslog.LOG_ERR, str(e), e.exitCode)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+# Benchmark the phases of a pyMigrate run on synthetic accounts, without touching real accounts or a real host.
+#
+# For each size a source passwd/shadow pair, a user list and a destination are generated in a scratch directory.
+# The destination is a directory served by the fake ssh in fakeTarget/, so the fetch and apply phases exercise the
+# real ssh code paths of migrate.py against local files. Each phase is timed on its own:
+#   parse       read and index the source passwd and shadow files
+#   fetch       read and index the destination's accounts over (fake) ssh
+#   categorize  sort users into those to migrate, delete and update
+#   apply       perform a fixed number of account changes at the destination
+#
+# Results can be saved as a baseline and later runs compared against it to catch regressions. Baselines are only
+# meaningful on the machine they were recorded on, so they aren't kept in the repository.
+#
+# Usage: ./benchmark.py [--sizes 10000,100000,1000000] [--changes COUNT] [--work-dir DIR]
+#                       [--save-baseline FILE] [--compare FILE] [--tolerance FRACTION] [-- MIGRATE OPTIONS...]
+# Example:
+#   ./benchmark.py --sizes 10000,100000 --save-baseline baseline.json
+#   ./benchmark.py --sizes 10000,100000 --compare baseline.json -- --batch -j 4
+
+import base64
+import hashlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTING_DIR))
+import migrate
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+DEFAULT_CHANGES = 300  # Account changes made in the apply phase, split between migrations, deletions and updates.
+DEFAULT_TOLERANCE = 0.25  # Fraction a phase may slow down by before it is reported as a regression.
+DESTINATION = 'root@benchmark'
+EXIT_CODE_REGRESSION = 1
+EXIT_CODE_BAD_ARGUMENTS = 2
+GROUP_ID = '100'
+
+
+# Time each phase of a run on a generated data set of one size and return the results.
+def benchmarkSize(workDir, size, changes):
+    printProgress("Generating " + str(size) + " accounts...")
+    sizeDir = os.path.join(workDir, str(size))
+    passwdPath, shadowPath, listedUsers = generateAccounts(sizeDir, size, changes)
+    os.environ['PYMIGRATE_FAKE_ROOT'] = os.path.join(sizeDir, 'hosts')
+    migrate.LOCAL_PASSWD_FILE, migrate.LOCAL_SHADOW_FILE = passwdPath, shadowPath
+
+    # Widen the UID range that pyMigrate manages when a size doesn't fit in it.
+    migrate.HIGHEST_USER_ID = max(migrate.HIGHEST_USER_ID, migrate.LOWEST_USER_ID + size + changes + 1)
+
+    results = {}
+    migrate.runStats = migrate.RunStats()
+    srcAccountDict, results['parse'] = timed(migrate.getLocalUsers)
+    status, output = migrate.openSshMaster(DESTINATION)
+    if status != 0:
+        raise migrate.MigrationError(output, migrate.EXIT_CODE_UNABLE_TO_CONNECT)
+    (destAccountDict, unchanged), results['fetch'] = timed(migrate.getRemoteUsers, DESTINATION, srcAccountDict)
+    (migratingUsers, doomedUsers, updatingUsers), results['categorize'] = \
+        timed(migrate.categorizeUsers, listedUsers, srcAccountDict, destAccountDict)
+
+    actions = migrate.buildActions(migratingUsers, doomedUsers, updatingUsers, srcAccountDict, destAccountDict)
+    statuses, results['apply'] = timed(migrate.applyActions, DESTINATION, actions)
+    failures = len([status for status in statuses if status != 0])
+    if failures:
+        printProgress("WARNING: " + str(failures) + " of " + str(len(actions)) + " account changes failed.")
+
+    results['accounts'], results['actions'] = size, len(actions)
+    results['sshProcesses'] = migrate.runStats.counters['sshProcesses']
+    results['remoteBytes'] = migrate.runStats.counters['remoteBytes']
+    results['actionLatency'] = migrate.runStats.percentiles()
+    results['parseRate'] = size / max(results['parse'], 1e-9)
+    results['applyPerAction'] = results['apply'] / max(len(actions), 1)
+    shutil.rmtree(sizeDir)
+    return results
+
+
+# Compare results to a saved baseline and return a list of regression descriptions.
+def compareToBaseline(results, baseline, tolerance):
+    regressions = []
+    for size, phases in sorted(results.items(), key=lambda item: int(item[0])):
+        if size not in baseline['results']:
+            continue
+        for phase in ('parse', 'fetch', 'categorize', 'applyPerAction'):
+            before, after = baseline['results'][size][phase], phases[phase]
+            change = (after - before) / max(before, 1e-9)
+            printProgress("  %8s accounts %-15s %10.4fs -> %10.4fs (%+.0f%%)" % (size, phase, before, after,
+                                                                               change * 100))
+            if change > tolerance:
+                regressions.append(size + " accounts " + phase + " slowed by " + str(int(change * 100)) + "%")
+    return regressions
+
+
+# Write a size's synthetic source files, user list and destination host directory, and return the source file
+# paths and the user list. A third of the changes are migrations (listed users missing at the destination), a third
+# are deletions (destination users missing at the source) and a third are updates (changed passwords).
+def generateAccounts(workDir, size, changes):
+    sourceDir, hostDir = os.path.join(workDir, 'source'), os.path.join(workDir, 'hosts', 'benchmark')
+    for directory in (sourceDir, os.path.join(hostDir, 'etc'), os.path.join(hostDir, 'mnt')):
+        os.makedirs(directory)
+
+    migrations = deletions = changes // 3
+    updates = changes - migrations - deletions
+    srcPasswd = open(os.path.join(sourceDir, 'passwd'), 'w')
+    srcShadow = open(os.path.join(sourceDir, 'shadow'), 'w')
+    destPasswd = open(os.path.join(hostDir, 'etc', 'passwd'), 'w')
+    destShadow = open(os.path.join(hostDir, 'etc', 'shadow'), 'w')
+    listedUsers = []
+    for systemFile in (srcPasswd, destPasswd):
+        systemFile.write("root:x:0:0:root:/root:/bin/bash\n")
+    for systemFile in (srcShadow, destShadow):
+        systemFile.write("root:*:17000:0:99999:7:::\n")
+
+    for i in range(size + deletions):
+        username, uid = 'bench' + str(i), str(migrate.LOWEST_USER_ID + 1 + i)
+        passwdLine = username + ':x:' + uid + ':' + GROUP_ID + ':Benchmark User ' + str(i) + \
+            ':/home:/usr/sbin/nologin\n'
+        password = passwordHash(str(i))
+        if i < size:
+            srcPasswd.write(passwdLine)
+            srcShadow.write(username + ':' + password + ':17000:0:99999:7:::\n')
+            listedUsers.append(username)
+        if i >= migrations:
+            if i >= size - updates and i < size:
+                password = passwordHash('changed' + str(i))
+            destPasswd.write(passwdLine)
+            destShadow.write(username + ':' + password + ':17000:0:99999:7:::\n')
+
+    for openFile in (srcPasswd, srcShadow, destPasswd, destShadow):
+        openFile.close()
+    with open(os.path.join(hostDir, 'etc', 'group'), 'w') as groupFile:
+        groupFile.write("root:x:0:\nusers:x:" + GROUP_ID + ":\n")
+
+    return os.path.join(sourceDir, 'passwd'), os.path.join(sourceDir, 'shadow'), set(listedUsers)
+
+
+# Make a SHA-512 crypt style hash that is unique to a seed and as incompressible as a real one.
+def passwordHash(seed):
+    digest = base64.b64encode(hashlib.sha512(seed).digest(), './').rstrip('=')
+    return '$6$' + hashlib.md5(seed).hexdigest()[:16] + '$' + digest
+
+
+# Print a message to stderr, keeping stdout for the results.
+def printProgress(msg):
+    sys.stderr.write(msg + "\n")
+
+
+# Take the benchmark's own options from the command line, leaving anything after "--" for migrate.py.
+def processCommandLineOptions():
+    settings = {'sizes': DEFAULT_SIZES, 'changes': DEFAULT_CHANGES, 'workDir': None, 'saveBaseline': None,
+                'compare': None, 'tolerance': DEFAULT_TOLERANCE, 'migrateOptions': []}
+    args = sys.argv[1:]
+    if '--' in args:
+        settings['migrateOptions'] = args[args.index('--') + 1:]
+        args = args[:args.index('--')]
+
+    try:
+        i = 0
+        while i < len(args):
+            if args[i] == '--sizes':
+                settings['sizes'] = [int(size) for size in args[i + 1].split(',')]
+            elif args[i] == '--changes':
+                settings['changes'] = int(args[i + 1])
+            elif args[i] == '--work-dir':
+                settings['workDir'] = args[i + 1]
+            elif args[i] == '--save-baseline':
+                settings['saveBaseline'] = args[i + 1]
+            elif args[i] == '--compare':
+                settings['compare'] = args[i + 1]
+            elif args[i] == '--tolerance':
+                settings['tolerance'] = float(args[i + 1])
+            else:
+                raise ValueError(args[i])
+            i += 2
+    except (IndexError, ValueError):
+        printProgress("Usage: " + sys.argv[0] + " [--sizes N,N,...] [--changes COUNT] [--work-dir DIR] "
+                      "[--save-baseline FILE] [--compare FILE] [--tolerance FRACTION] [-- MIGRATE OPTIONS...]")
+        exit(EXIT_CODE_BAD_ARGUMENTS)
+    return settings
+
+
+# Run a function and return its result along with the seconds it took.
+def timed(function, *args):
+    startTime = time.time()
+    result = function(*args)
+    return result, time.time() - startTime
+
+
+def main():
+    settings = processCommandLineOptions()
+
+    # Set up migrate.py's options as if it had been run with the given ones, quiet unless asked otherwise.
+    sys.argv = ['migrate.py', '--quiet'] + settings['migrateOptions'] + [DESTINATION, 'USER_LIST_FILE']
+    migrate.processCommandLineOptions()
+    migrate.options['cache'] = False
+    os.environ['PATH'] = os.path.join(TESTING_DIR, 'fakeTarget') + os.pathsep + os.environ['PATH']
+
+    workDir = tempfile.mkdtemp(prefix='pymigrate-benchmark-', dir=settings['workDir'])
+    results = {}
+    try:
+        for size in settings['sizes']:
+            results[str(size)] = benchmarkSize(workDir, size, settings['changes'])
+            migrate.closeSshMasters()
+    finally:
+        shutil.rmtree(workDir)
+
+    report = {'python': platform.python_version(), 'machine': platform.node(),
+              'migrateOptions': settings['migrateOptions'], 'changes': settings['changes'], 'results': results}
+    print json.dumps(report, indent=2, sort_keys=True)
+
+    if settings['saveBaseline']:
+        with open(settings['saveBaseline'], 'w') as baselineFile:
+            json.dump(report, baselineFile, indent=2, sort_keys=True)
+        printProgress("Saved baseline to " + settings['saveBaseline'])
+
+    if settings['compare']:
+        with open(settings['compare']) as baselineFile:
+            baseline = json.load(baselineFile)
+        printProgress("Compared to baseline " + settings['compare'] + ":")
+        regressions = compareToBaseline(results, baseline, settings['tolerance'])
+        if regressions:
+            printProgress("REGRESSIONS:\n  " + "\n  ".join(regressions))
+            exit(EXIT_CODE_REGRESSION)
+
+
+main()
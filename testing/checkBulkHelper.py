@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+# Check that the bulk helper (migrate.REMOTE_BULK_HELPER) rewrites account files the way it should, without
+# touching real accounts or a real host.
+#
+# A small passwd, shadow and group set is written to a scratch directory and a mix of changes is applied to it with
+# applyActionsInBulk() through the fake ssh in fakeTarget/, pointing the helper at the scratch directory. The check
+# then compares the resulting files to the expected ones, makes sure the previous files were kept as passwd-,
+# shadow- and group- like the standard tools keep them, and that accounts outside the managed UID range were left
+# exactly as they were, even when a change asked for them.
+#
+# Usage: ./checkBulkHelper.py [--work-dir DIR]
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTING_DIR))
+import migrate
+
+DESTINATION = 'root@bulkcheck'
+EXIT_CODE_FAILED = 1
+EXIT_CODE_BAD_ARGUMENTS = 2
+
+PASSWD = """root:x:0:0:root:/root:/bin/bash
+daemon:x:1:1:daemon:/usr/sbin:/usr/sbin/nologin
+keep:x:1001:100:Keep Same:/home:/usr/sbin/nologin
+gone:x:1002:100:Gone:/home:/usr/sbin/nologin
+chg:x:1003:100:Old Name:/home:/usr/sbin/nologin
+nobody:x:65534:65534:nobody:/nonexistent:/usr/sbin/nologin
+"""
+SHADOW = """root:*:17000:0:99999:7:::
+daemon:*:17000:0:99999:7:::
+keep:$6$keep:17000:0:99999:7:::
+gone:$6$gone:17000:0:99999:7:::
+chg:$6$old:17000:0:99999:7:::
+nobody:*:17000:0:99999:7:::
+"""
+GROUP = """root:x:0:
+users:x:100:keep,gone
+nogroup:x:65534:
+"""
+
+
+# Compare the contents of a file to the expected text, and return a list with a failure description if they differ.
+def checkFile(path, expected):
+    try:
+        with open(path) as checkedFile:
+            actual = checkedFile.read()
+    except IOError as e:
+        return [os.path.basename(path) + " can't be read: " + str(e)]
+    if actual == expected:
+        return []
+    return [os.path.basename(path) + " differs:\n--- expected\n" + expected + "--- actual\n" + actual]
+
+
+# Apply the changes to a scratch copy of the account files and return a list of failure descriptions.
+def checkHelper(workDir):
+    etcDir, hostDir = os.path.join(workDir, 'accounts') + '/', os.path.join(workDir, 'hosts', 'bulkcheck')
+    for directory in (etcDir, os.path.join(hostDir, 'etc')):
+        os.makedirs(directory)
+    for name, text in (('passwd', PASSWD), ('shadow', SHADOW), ('group', GROUP)):
+        with open(os.path.join(etcDir, name), 'w') as accountFile:
+            accountFile.write(text)
+    for name in ('passwd', 'shadow'):
+        open(os.path.join(hostDir, 'etc', name), 'w').close()
+    os.environ['PYMIGRATE_FAKE_ROOT'] = os.path.dirname(hostDir)
+
+    # Migrate, delete and update one managed account each, and try to delete and update unmanaged ones.
+    srcAccountDict = {'new': migrate.Account('new', '$6$new', '1004', '100', 'New User'),
+                      'chg': migrate.Account('chg', '$6$changed', '1005', '100', 'New Name'),
+                      'nobody': migrate.Account('nobody', '*', '65533', '65534', 'nobody')}
+    destAccountDict = {'gone': migrate.Account('gone', '$6$gone', '1002', '100', 'Gone'),
+                       'daemon': migrate.Account('daemon', '*', '1', '1', 'daemon'),
+                       'chg': migrate.Account('chg', '$6$old', '1003', '100', 'Old Name'),
+                       'nobody': migrate.Account('nobody', '*', '65534', '65534', 'nobody')}
+    actions = migrate.buildActions(['new'], ['gone', 'daemon'], ['chg', 'nobody'], srcAccountDict, destAccountDict)
+    statuses = migrate.applyActionsInBulk(DESTINATION, actions, etcDir)
+
+    failures = []
+    expectedStatuses = {'new': 0, 'gone': 0, 'chg': 0, 'daemon': 2, 'nobody': 2}
+    for action, status in zip(actions, statuses):
+        if status != expectedStatuses[action.username]:
+            failures.append(action.kind + " " + action.username + " exited with " + str(status) + " instead of " +
+                            str(expectedStatuses[action.username]))
+
+    today = str(int(time.time() / 86400))
+    failures += checkFile(etcDir + 'passwd', PASSWD.replace("gone:x:1002:100:Gone:/home:/usr/sbin/nologin\n", "")
+                          .replace("chg:x:1003:100:Old Name:", "chg:x:1005:100:New Name:") +
+                          "new:x:1004:100:New User:/home:/usr/sbin/nologin\n")
+    failures += checkFile(etcDir + 'shadow', SHADOW.replace("gone:$6$gone:17000:0:99999:7:::\n", "")
+                          .replace("chg:$6$old:17000:", "chg:$6$changed:" + today + ":") +
+                          "new:$6$new:" + today + ":0:99999:7:::\n")
+    failures += checkFile(etcDir + 'group', GROUP.replace("keep,gone", "keep"))
+    for name, text in (('passwd-', PASSWD), ('shadow-', SHADOW), ('group-', GROUP)):
+        failures += checkFile(etcDir + name, text)
+    for name in ('passwd', 'shadow'):
+        failures += checkFile(os.path.join(hostDir, 'etc', name), "")
+
+    # The unmanaged accounts must come through byte for byte, whatever the changes asked for.
+    with open(etcDir + 'passwd') as passwdFile:
+        unmanaged = [line for line in passwdFile if not migrate.LOWEST_USER_ID <= int(line.split(':')[2]) <=
+                     migrate.HIGHEST_USER_ID]
+    if unmanaged != [line + "\n" for line in PASSWD.splitlines() if line.split(':')[0] in
+                     ('root', 'daemon', 'nobody')]:
+        failures.append("Accounts outside the managed UID range changed:\n" + "".join(unmanaged))
+    return failures
+
+
+# Print a message to stderr.
+def printProgress(msg):
+    sys.stderr.write(msg + "\n")
+
+
+def main():
+    args = sys.argv[1:]
+    if args and (len(args) != 2 or args[0] != '--work-dir'):
+        printProgress("Usage: " + sys.argv[0] + " [--work-dir DIR]")
+        exit(EXIT_CODE_BAD_ARGUMENTS)
+
+    # Set up migrate.py's options as if it had been run quietly with its defaults.
+    sys.argv = ['migrate.py', '--quiet', DESTINATION, 'USER_LIST_FILE']
+    migrate.processCommandLineOptions()
+    migrate.runStats = migrate.RunStats()
+    os.environ['PATH'] = os.path.join(TESTING_DIR, 'fakeTarget') + os.pathsep + os.environ['PATH']
+
+    workDir = tempfile.mkdtemp(prefix='pymigrate-bulkcheck-', dir=args[1] if args else None)
+    try:
+        failures = checkHelper(workDir)
+    finally:
+        shutil.rmtree(workDir)
+
+    if failures:
+        printProgress("FAILED:\n  " + "\n  ".join(failures))
+        exit(EXIT_CODE_FAILED)
+    printProgress("The bulk helper made the expected changes.")
+
+
+main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+# Check that migrate.py reads the VCN user database the same way fetch-usernames.pl does, without touching the
+# real database.
+#
+# A database is built with buildFakeDatabase.pl in a scratch directory, and the users with PPP access (types o, p
+# and v) are listed both by fetch-usernames.pl, with its paths pointed into the scratch directory, and by
+# migrate.py's direct read under the database's lock. The check fails if the two lists differ, or if the direct
+# read doesn't refuse a database whose lock is held by another program.
+#
+# Python only opens perl's dbm format if it was built with the matching dbm module (usually ndbm or gdbm). Without
+# one, perl dumps the database's records and the direct read is run on a dumbdbm copy of them instead, which every
+# Python can open, so the listing is still compared on the same records.
+#
+# Usage: ./checkUserDatabase.py [--work-dir DIR]
+
+import anydbm
+import dumbdbm
+import fcntl
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTING_DIR))
+import migrate
+
+FETCH_USERNAMES_SCRIPT = os.path.join(os.path.dirname(TESTING_DIR), 'fetch-usernames.pl')
+BUILD_DATABASE_SCRIPT = os.path.join(TESTING_DIR, 'buildFakeDatabase.pl')
+EXIT_CODE_FAILED = 1
+EXIT_CODE_BAD_ARGUMENTS = 2
+
+
+# Copy the records of the database perl built into a dumbdbm database next to it, and return the copy's path.
+def copyToDumbDatabase(databasePath):
+    dump = subprocess.check_output(['perl', '-e', 'dbmopen(%db, $ARGV[0], undef) or die("$!\\n"); ' +
+                                    'print "$_\\0$db{$_}\\0" foreach (keys %db);', databasePath])
+    fields = dump.split('\0')[:-1]
+    copyPath = databasePath + '-dumbdbm'
+    database = dumbdbm.open(copyPath, 'c')
+    for key, value in zip(fields[0::2], fields[1::2]):
+        database[key] = value
+    database.close()
+    return copyPath
+
+
+# Build the database in a scratch directory, list its users both ways and return a list of failure descriptions.
+def checkDatabase(workDir):
+    databasePath, listPath = os.path.join(workDir, 'user-data'), os.path.join(workDir, 'users.txt')
+    migrate.DATABASE_LOCK_FILE = os.path.join(workDir, 'lock-file')
+    if subprocess.call(['perl', BUILD_DATABASE_SCRIPT], cwd=workDir) != 0:
+        return ["buildFakeDatabase.pl failed"]
+
+    # Run fetch-usernames.pl with its database, lock files and pyMigrate's execution lock in the scratch directory.
+    with open(FETCH_USERNAMES_SCRIPT) as scriptFile:
+        script = scriptFile.read().replace('/usr/local/database/', workDir + '/') \
+                                  .replace(migrate.LOCK_FILE, os.path.join(workDir, 'migrate.lck'))
+    process = subprocess.Popen(['perl', '-', listPath], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    output = process.communicate(script)[0]
+    if process.returncode != 0 or not os.path.exists(listPath):
+        return ["fetch-usernames.pl failed:\n" + output]
+    with open(listPath) as listFile:
+        scriptUsers = set(listFile.read().split())
+
+    # Fall back to a copy of the records if this Python has no dbm module for perl's format.
+    try:
+        anydbm.open(databasePath, 'r').close()
+    except Exception:  # Each dbm module, and the format detection itself, raise errors of their own.
+        printProgress("This Python can't open perl's dbm format, so a dumbdbm copy of the records is read instead.")
+        databasePath = copyToDumbDatabase(databasePath)
+
+    failures = []
+    try:
+        directUsers = migrate.readUserDatabase(databasePath)
+    except migrate.MigrationError as e:
+        failures.append("The direct read failed: " + str(e))
+    else:
+        if directUsers != scriptUsers:
+            failures.append("The direct read listed " + ' '.join(sorted(directUsers)) + " but fetch-usernames.pl " +
+                            "listed " + ' '.join(sorted(scriptUsers)))
+
+    # The direct read must give way to another program holding the database's lock.
+    with open(migrate.DATABASE_LOCK_FILE, 'w') as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            migrate.readUserDatabase(databasePath)
+            failures.append("The direct read ignored the database's lock")
+        except migrate.MigrationError as e:
+            if e.exitCode != migrate.EXIT_CODE_DATABASE_LOCKED:
+                failures.append("The direct read of a locked database failed with: " + str(e))
+    return failures
+
+
+# Print a message to stderr.
+def printProgress(msg):
+    sys.stderr.write(msg + "\n")
+
+
+def main():
+    args = sys.argv[1:]
+    if args and (len(args) != 2 or args[0] != '--work-dir'):
+        printProgress("Usage: " + sys.argv[0] + " [--work-dir DIR]")
+        exit(EXIT_CODE_BAD_ARGUMENTS)
+
+    # Set up migrate.py's options as if it had been run quietly with its defaults.
+    sys.argv = ['migrate.py', '--quiet', 'root@localhost', 'USER_LIST_FILE']
+    migrate.processCommandLineOptions()
+
+    workDir = tempfile.mkdtemp(prefix='pymigrate-dbcheck-', dir=args[1] if args else None)
+    try:
+        failures = checkDatabase(workDir)
+    finally:
+        shutil.rmtree(workDir)
+
+    if failures:
+        printProgress("FAILED:\n  " + "\n  ".join(failures))
+        exit(EXIT_CODE_FAILED)
+    printProgress("The direct read listed the same users as fetch-usernames.pl.")
+
+
+main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# A stand-in for useradd, usermod, deluser, groupadd and getent that edits or reads the passwd, shadow and group
+# files of a fake host directory (see ssh in this directory) instead of the real ones. It is run through the links in sbin/, takes its
+# role from the name it was run by and understands only the arguments that pyMigrate passes. The fake host's
+# directory is taken from $PYMIGRATE_FAKE_ROOT_DIR, which the fake ssh sets.
+
+import fcntl
+import os
+import sys
+
+EXIT_CODE_BAD_ARGUMENTS = 2
+EXIT_CODE_KEY_NOT_FOUND = 2
+EXIT_CODE_UID_IN_USE = 4
+EXIT_CODE_NO_SUCH_GROUP = 6
+EXIT_CODE_NO_SUCH_USER = 6
+EXIT_CODE_USER_EXISTS = 9
+FLAGS = ('-M', '-m', '-quiet', '--quiet')
+
+
+# Read a colon-separated file into a list of field lists.
+def readRows(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as inFile:
+        return [line.rstrip('\n').split(':') for line in inFile]
+
+
+# Replace a colon-separated file with a list of field lists.
+def writeRows(path, rows):
+    with open(path + '+', 'w') as outFile:
+        outFile.write(''.join([':'.join(row) + '\n' for row in rows]))
+    os.rename(path + '+', path)
+
+
+# Print an error and quit the way the real tools do.
+def fail(tool, msg, exitCode):
+    sys.stderr.write(tool + ": " + msg + "\n")
+    exit(exitCode)
+
+
+def main():
+    tool = os.path.basename(sys.argv[0])
+    etcDir = os.path.join(os.environ['PYMIGRATE_FAKE_ROOT_DIR'], 'etc')
+    passwdPath, shadowPath, groupPath = [os.path.join(etcDir, name) for name in ('passwd', 'shadow', 'group')]
+
+    # Look up entries like getent does, without taking any lock.
+    if tool == 'getent':
+        if len(sys.argv) < 2 or sys.argv[1] not in ('passwd', 'shadow', 'group'):
+            fail(tool, "unknown database", EXIT_CODE_BAD_ARGUMENTS)
+        keys = sys.argv[2:]
+        rows = readRows({'passwd': passwdPath, 'shadow': shadowPath, 'group': groupPath}[sys.argv[1]])
+        found = [row for row in rows if not keys or row[0] in keys]
+        sys.stdout.write(''.join([':'.join(row) + '\n' for row in found]))
+        exit(0 if len(set([row[0] for row in found])) >= len(set(keys)) else EXIT_CODE_KEY_NOT_FOUND)
+
+    # Take options and the account name from the command line.
+    args, opts, i = sys.argv[1:], {}, 0
+    while i < len(args) - 1:
+        if args[i] in FLAGS:
+            i += 1
+        else:
+            opts[args[i]] = args[i + 1]
+            i += 2
+    if not args or args[-1].startswith('-'):
+        fail(tool, "missing account name", EXIT_CODE_BAD_ARGUMENTS)
+    name = args[-1]
+
+    # Hold the same lock that the real tools take with lckpwdf() while editing.
+    with open(os.path.join(etcDir, '.pwd.lock'), 'w') as lockFile:
+        fcntl.lockf(lockFile, fcntl.LOCK_EX)
+
+        if tool == 'groupadd':
+            groups = readRows(groupPath)
+            groups.append([name, 'x', opts.get('-g', '1000'), ''])
+            writeRows(groupPath, groups)
+            return
+
+        passwdRows, shadowRows = readRows(passwdPath), readRows(shadowPath)
+        existing = [row for row in passwdRows if row[0] == name]
+        if tool == 'useradd':
+            if existing:
+                fail(tool, "user '" + name + "' already exists", EXIT_CODE_USER_EXISTS)
+            if [row for row in passwdRows if row[2] == opts['-u']]:
+                fail(tool, "UID " + opts['-u'] + " is not unique", EXIT_CODE_UID_IN_USE)
+            if not [row for row in readRows(groupPath) if opts['-g'] in (row[0], row[2])]:
+                fail(tool, "group '" + opts['-g'] + "' does not exist", EXIT_CODE_NO_SUCH_GROUP)
+            passwdRows.append([name, 'x', opts['-u'], opts['-g'], opts.get('-c', ''), opts.get('-d', '/home'),
+                               opts.get('-s', '/bin/sh')])
+            shadowRows.append([name, opts.get('-p', '!'), '17000', '0', '99999', '7', '', '', ''])
+        elif tool == 'usermod':
+            if not existing:
+                fail(tool, "user '" + name + "' does not exist", EXIT_CODE_NO_SUCH_USER)
+            if '-u' in opts and [row for row in passwdRows if row[2] == opts['-u'] and row[0] != name]:
+                fail(tool, "UID '" + opts['-u'] + "' already exists", EXIT_CODE_UID_IN_USE)
+            for flag, field in (('-u', 2), ('-g', 3), ('-c', 4)):
+                if flag in opts:
+                    existing[0][field] = opts[flag]
+            if '-p' in opts:
+                for row in shadowRows:
+                    if row[0] == name:
+                        row[1] = opts['-p']
+        elif tool == 'deluser':
+            if not existing:
+                fail(tool, "The user `" + name + "' does not exist.", EXIT_CODE_BAD_ARGUMENTS)
+            passwdRows = [row for row in passwdRows if row[0] != name]
+            shadowRows = [row for row in shadowRows if row[0] != name]
+        else:
+            fail(tool, "unknown tool", EXIT_CODE_BAD_ARGUMENTS)
+
+        writeRows(passwdPath, passwdRows)
+        writeRows(shadowPath, shadowRows)
+
+
+main()